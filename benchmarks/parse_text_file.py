@@ -0,0 +1,56 @@
+"""Benchmark parse_text_file on synthetic batch files.
+
+Usage: python benchmarks/parse_text_file.py [lines ...]   (default: 1000 10000 100000)
+
+Each synthetic file mimics a course dump: a title line and video URL per
+lecture, usually followed by a PDF title and PDF URL. Time per line should
+stay flat as the file grows.
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from helpers.batchfile import parse_text_file
+
+def make_batch_file(path, line_count):
+    """Write a synthetic batch file with roughly `line_count` lines"""
+    with open(path, 'w', encoding='utf-8') as f:
+        lines = 0
+        lecture = 0
+        while lines < line_count:
+            lecture += 1
+            f.write(f"[Physics] Lecture {lecture}: Kinematics part {lecture}\n")
+            f.write(f"https://cdn.example.com/course/{lecture}/index.m3u8?token=abc{lecture}\n")
+            lines += 2
+            if lecture % 4:
+                f.write(f"PDF - [Physics] Lecture {lecture} notes\n")
+                f.write(f"https://files.example.com/notes/{lecture}.pdf\n")
+                lines += 2
+            if lecture % 7 == 0:
+                f.write(f"[Physics] Lecture {lecture} DPP:https://files.example.com/dpp/{lecture}.pdf\n")
+                lines += 1
+
+async def run(line_counts):
+    with tempfile.TemporaryDirectory() as tmp:
+        for line_count in line_counts:
+            path = os.path.join(tmp, f"batch_{line_count}.txt")
+            make_batch_file(path, line_count)
+            start = time.perf_counter()
+            entries = await parse_text_file(path)
+            elapsed = time.perf_counter() - start
+            pdfs = sum(len(entry['pdfs']) for entry in entries)
+            print(
+                f"{line_count:>8} lines: {elapsed:8.3f}s "
+                f"({elapsed / line_count * 1e6:6.2f}us/line, {len(entries)} videos, {pdfs} PDFs)"
+            )
+
+if __name__ == "__main__":
+    # Per-entry INFO logs would dominate the timings
+    logging.basicConfig(level=logging.WARNING)
+    counts = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000]
+    asyncio.run(run(counts))
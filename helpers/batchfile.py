@@ -0,0 +1,233 @@
+import re
+import codecs
+import logging
+import aiofiles
+
+# Constants
+LOOKBEHIND_LINES = 3  # Lines searched backwards for a missing title
+LOOKAHEAD_LINES = 2  # Lines searched forwards for the URL of a PDF title
+READ_CHUNK_SIZE = 64 * 1024  # Characters read from disk at a time
+
+logger = logging.getLogger(__name__)
+
+def is_pdf_url(url):
+    """Check if URL likely points to a PDF"""
+    url_lower = url.lower()
+    return (url_lower.endswith('.pdf') or
+            'pdf' in url_lower or
+            'application/pdf' in url_lower or
+            '.pdf?' in url_lower)
+
+def is_video_url(url):
+    """Check if URL likely points to a video (M3U8)"""
+    return '.m3u8' in url.lower()
+
+def extract_url_info(line):
+    """Find the first URL in a line and classify it, None if there is none"""
+    if 'http' not in line:
+        return None
+    # Extract URL from line (handle various formats)
+    url_match = re.search(r'https?://[^\s<>"\[\]]+', line)
+    if not url_match:
+        return None
+    url = url_match.group()
+    # Get text before URL as potential title
+    title_part = line[:url_match.start()].strip()
+    # Clean up title (remove common separators)
+    title_part = re.sub(r'[:\-\|]+$', '', title_part).strip()
+    return {
+        'url': url,
+        'title_part': title_part,
+        'is_video': is_video_url(url),
+        'is_pdf': is_pdf_url(url)
+    }
+
+async def _split_lines(chunks):
+    """Turn an async iterable of text chunks into lines"""
+    pending = ''
+    async for text in chunks:
+        # Same line breaks as universal-newline reads; the blank lines this
+        # leaves behind for \r\n are skipped by the parser
+        *lines, pending = (pending + text.replace('\r', '\n')).split('\n')
+        for line in lines:
+            yield line
+    yield pending
+
+async def iter_file_lines(file_path):
+    """Yield the lines of a text file without reading it all into memory"""
+    async def chunks():
+        async with aiofiles.open(file_path, 'r', encoding='utf-8') as file:
+            while True:
+                text = await file.read(READ_CHUNK_SIZE)
+                if not text:
+                    return
+                yield text
+
+    async for line in _split_lines(chunks()):
+        yield line
+
+async def iter_media_lines(client, message):
+    """Yield the lines of a Telegram document while it is still downloading"""
+    async def chunks():
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        async for chunk in client.stream_media(message):
+            yield decoder.decode(chunk)
+        yield decoder.decode(b'', final=True)
+
+    async for line in _split_lines(chunks()):
+        yield line
+
+def _process_line(i, window, known_lines, state):
+    """Apply one line to the parser state; return an entry it completed, if any"""
+    line, line_url_info = window[i]
+    line_lower = line.lower()
+    current_video = state['current']
+
+    # Check if this line contains a video URL
+    video_url_info = line_url_info if line_url_info and line_url_info['is_video'] else None
+
+    if video_url_info:
+        # Found a video URL - create new entry
+        title = video_url_info['title_part']
+
+        # If no title in URL line, look for title in previous lines
+        if not title:
+            # Look back up to 3 lines for a title
+            for j in range(max(0, i-LOOKBEHIND_LINES), i):
+                prev_line, prev_url_info = window[j]
+                if prev_line and prev_url_info is None:
+                    # This line doesn't contain a URL, might be a title
+                    if not prev_line.lower().startswith(('pdf', 'note', 'link')):
+                        title = prev_line
+                        break
+
+        state['videos'] += 1
+        if not title:
+            title = f"Video_{state['videos']}"
+
+        state['current'] = {
+            'type': 'video',
+            'title': title,
+            'url': video_url_info['url'],
+            'pdfs': []
+        }
+        logger.info(f"🎥 Found video: {title[:50]}...")
+        # Nothing can be attached to the previous video any more
+        return current_video
+
+    # Check if this line contains a PDF URL
+    pdf_url_info = line_url_info if line_url_info and line_url_info['is_pdf'] else None
+
+    if pdf_url_info and current_video:
+        # Found a PDF URL - associate with current video
+        pdf_title = pdf_url_info['title_part']
+
+        # If no title in URL line, look for title in previous lines or use default
+        if not pdf_title:
+            # Look back up to 2 lines for a PDF title
+            for j in range(max(0, i-2), i):
+                prev_line, prev_url_info = window[j]
+                if prev_line and prev_url_info is None:
+                    # Check if this looks like a PDF title
+                    if (prev_line.lower().startswith('pdf') or
+                        'pdf' in prev_line.lower() or
+                        prev_line.startswith('[') or
+                        len(prev_line) > 10):  # Reasonable title length
+                        pdf_title = prev_line
+                        break
+
+        if not pdf_title:
+            pdf_title = f"PDF for {current_video['title']}"
+
+        # Clean PDF title
+        pdf_title = re.sub(r'^pdf[\s\-:]*', '', pdf_title, flags=re.IGNORECASE).strip()
+
+        current_video['pdfs'].append({
+            'title': pdf_title,
+            'url': pdf_url_info['url']
+        })
+        logger.info(f"📚 Associated PDF: {pdf_title[:50]}... with video: {current_video['title'][:30]}...")
+        return None
+
+    # Check for standalone PDF indicators (lines that mention PDF but don't have URLs)
+    if (current_video and
+        ('pdf' in line_lower or 'document' in line_lower) and
+        'http' not in line and
+        len(line) > 5):  # Reasonable length for a title
+
+        # This might be a PDF title, check next few lines for URL
+        for j in range(i+1, min(known_lines, i+1+LOOKAHEAD_LINES)):
+            next_line, next_url_info = window[j]
+            if 'http' in next_line:
+                # Check if this URL is a PDF
+                if next_url_info and next_url_info['is_pdf']:
+                    # Found matching PDF URL
+                    pdf_title = re.sub(r'^pdf[\s\-:]*', '', line, flags=re.IGNORECASE).strip()
+                    current_video['pdfs'].append({
+                        'title': pdf_title,
+                        'url': next_url_info['url']
+                    })
+                    logger.info(f"📚 Found PDF title-URL pair: {pdf_title[:50]}...")
+                break
+    return None
+
+async def iter_entries(lines):
+    """Parse batch-file lines into video entries, yielding each one once it is complete.
+
+    Single pass over an async iterable of lines: only a few lines around the
+    cursor are kept, so memory stays flat and the first entry is available
+    as soon as the next video line has been read.
+    """
+    window = {}  # line index -> (stripped line, url info)
+    state = {'current': None, 'videos': 0}
+    known_lines = 0
+
+    async for raw_line in lines:
+        line = raw_line.strip()
+        if not line:
+            continue
+        window[known_lines] = (line, extract_url_info(line))
+        known_lines += 1
+
+        # Lines are handled once their look-ahead is available
+        i = known_lines - 1 - LOOKAHEAD_LINES
+        if i >= 0:
+            finished = _process_line(i, window, known_lines, state)
+            window.pop(i - LOOKBEHIND_LINES, None)
+            if finished:
+                yield finished
+
+    for i in range(max(0, known_lines - LOOKAHEAD_LINES), known_lines):
+        finished = _process_line(i, window, known_lines, state)
+        if finished:
+            yield finished
+
+    if state['current']:
+        yield state['current']
+
+async def parse_text_file(file_path):
+    """Improved text file parser with better PDF recognition, linear in file size"""
+    entries = []
+
+    try:
+        async for entry in iter_entries(iter_file_lines(file_path)):
+            entries.append(entry)
+
+        # Summary
+        total_videos = len(entries)
+        total_pdfs = sum(len(entry['pdfs']) for entry in entries)
+        logger.info(f"📊 FINAL PARSING RESULT:")
+        logger.info(f"   📹 Videos found: {total_videos}")
+        logger.info(f"   📚 PDFs found: {total_pdfs}")
+
+        # Debug output for first few entries
+        for idx, entry in enumerate(entries[:3]):
+            logger.info(f"   Entry {idx+1}: {entry['title'][:40]}... ({len(entry['pdfs'])} PDFs)")
+            for p_idx, pdf in enumerate(entry['pdfs']):
+                logger.info(f"      PDF {p_idx+1}: {pdf['title'][:40]}...")
+
+        return entries
+
+    except Exception as e:
+        logger.error(f"Error parsing file: {str(e)}")
+        return []
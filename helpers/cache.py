@@ -0,0 +1,204 @@
+import os
+import shutil
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+# Constants
+CACHE_DIR = os.environ.get("DOWNLOAD_CACHE_DIR", "download_cache")
+CACHE_MAX_BYTES = int(float(os.environ.get("DOWNLOAD_CACHE_GB", 10)) * 1024 ** 3)  # 0 disables the cache
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+YOUTUBE_HOSTS = ('youtube.com', 'www.youtube.com', 'm.youtube.com', 'music.youtube.com')
+
+logger = logging.getLogger(__name__)
+
+def normalize_url(url):
+    """Canonical form of a URL so trivially different spellings share a cache entry"""
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or '').lower()
+    query = dict(parse_qsl(parts.query, keep_blank_values=True))
+
+    # Every YouTube link form collapses to the video id
+    video_id = None
+    if host == 'youtu.be':
+        video_id = parts.path.strip('/').split('/')[0]
+    elif host in YOUTUBE_HOSTS:
+        if parts.path.startswith('/shorts/'):
+            video_id = parts.path.split('/')[2]
+        elif parts.path == '/watch':
+            video_id = query.get('v')
+    if video_id:
+        return f"youtube:{video_id}"
+
+    scheme = parts.scheme.lower()
+    netloc = host
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc = f"{host}:{parts.port}"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, parts.path or '/', query, ''))
+
+def cache_key(url, variant, output_format):
+    """Content address for one rendition of a URL"""
+    raw = f"{normalize_url(url)}|{variant}|{output_format}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+def _link_or_copy(src, dest):
+    """Give `dest` its own name for `src`, without copying when the filesystem allows it"""
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+class DownloadCache:
+    """Size-capped LRU cache of finished downloads on disk.
+
+    Entries live in `<root>/<key>/<original file name>`. Callers always get
+    their own hard link (or copy) of a cached file, so they can delete it
+    after uploading exactly as they would a fresh download, and eviction
+    never pulls a file out from under an upload in progress.
+
+    A caller that misses becomes the producer for that key: `acquire`
+    returns None and later callers for the same key wait until it calls
+    `put` (or `release` on failure) instead of downloading again.
+    """
+
+    def __init__(self, root=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (path, size), least recently used first
+        self.size = 0
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.loaded = False
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _load(self):
+        """Index what a previous run left on disk, oldest use first"""
+        self.loaded = True
+        if not self.enabled:
+            return
+        os.makedirs(self.root, exist_ok=True)
+        found = []
+        for key in os.listdir(self.root):
+            entry_dir = os.path.join(self.root, key)
+            files = os.listdir(entry_dir) if os.path.isdir(entry_dir) else []
+            if key.endswith('.tmp') or len(files) != 1:
+                # Interrupted store
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                continue
+            path = os.path.join(entry_dir, files[0])
+            stat = os.stat(path)
+            found.append((stat.st_mtime, key, path, stat.st_size))
+        for _, key, path, size in sorted(found):
+            self.entries[key] = (path, size)
+            self.size += size
+        logger.info(f"Download cache: {len(self.entries)} entries, {self.size / 1024 ** 3:.2f} GB in {self.root}")
+        self._evict()
+
+    def _evict(self):
+        while self.size > self.max_bytes and self.entries:
+            key, (path, size) = self.entries.popitem(last=False)
+            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+            self.size -= size
+            logger.info(f"Evicted {os.path.basename(path)} from the download cache")
+
+    async def acquire(self, key, dest_dir='.'):
+        """Return a private copy of a cached file in `dest_dir`, or None on a miss.
+
+        On a miss the caller must follow up with `put` or `release`.
+        """
+        if not self.loaded:
+            self._load()
+        while key in self.pending:
+            await asyncio.shield(self.pending[key])
+
+        entry = self.entries.get(key) if self.enabled else None
+        if entry and os.path.exists(entry[0]):
+            path = entry[0]
+            self.entries.move_to_end(key)
+            os.utime(path)
+            name, ext = os.path.splitext(os.path.basename(path))
+            dest = os.path.join(dest_dir, name + ext)
+            counter = 1
+            while os.path.exists(dest):
+                dest = os.path.join(dest_dir, f"{name}_{counter}{ext}")
+                counter += 1
+            await asyncio.to_thread(_link_or_copy, path, dest)
+            self.hits += 1
+            logger.info(f"Download cache hit: {os.path.basename(path)}")
+            return dest
+        if entry:
+            # Removed behind our back
+            self.entries.pop(key)
+            self.size -= entry[1]
+
+        self.misses += 1
+        self.pending[key] = asyncio.get_running_loop().create_future()
+        return None
+
+    async def put(self, key, path):
+        """Store a finished download and wake up anyone waiting for it"""
+        try:
+            size = os.path.getsize(path)
+            if self.enabled and size <= self.max_bytes:
+                entry_dir = os.path.join(self.root, key)
+                tmp_dir = f"{entry_dir}.tmp"
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                os.makedirs(tmp_dir)
+                await asyncio.to_thread(_link_or_copy, path, os.path.join(tmp_dir, os.path.basename(path)))
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                os.replace(tmp_dir, entry_dir)
+                old = self.entries.pop(key, None)
+                if old:
+                    self.size -= old[1]
+                self.entries[key] = (os.path.join(entry_dir, os.path.basename(path)), size)
+                self.size += size
+                self._evict()
+        except Exception as e:
+            logger.error(f"Could not cache {path}: {str(e)}")
+        finally:
+            self.release(key)
+
+    def release(self, key):
+        """Give up on producing `key`; safe to call more than once"""
+        pending = self.pending.pop(key, None)
+        if pending and not pending.done():
+            pending.set_result(None)
+
+    def discard(self, key):
+        """Drop a stored entry that must not be served again"""
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.size -= entry[1]
+            shutil.rmtree(os.path.dirname(entry[0]), ignore_errors=True)
+
+    async def fetch(self, key, producer, dest_dir='.'):
+        """Return a cached copy of `key`, running `producer()` for the file on a miss"""
+        cached = await self.acquire(key, dest_dir)
+        if cached:
+            return cached
+        try:
+            path = await producer()
+            if path and os.path.exists(path):
+                await self.put(key, path)
+            return path
+        finally:
+            self.release(key)
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'size': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'in_flight': len(self.pending),
+        }
+
+cache = DownloadCache()
@@ -0,0 +1,348 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from helpers.hls import SEGMENT_RESTART
+
+# Constants
+STDERR_TAIL_LINES = 50  # ffmpeg stderr lines kept for error reports
+CPU_COUNT = os.cpu_count() or 1
+FFMPEG_SLOTS = int(os.environ.get("FFMPEG_SLOTS", max(1, CPU_COUNT // 2)))  # Concurrent ffmpeg processes
+FFMPEG_THREADS = int(os.environ.get("FFMPEG_THREADS", 0)) or max(1, CPU_COUNT // FFMPEG_SLOTS)  # Threads per process
+FFMPEG_QUEUE_LIMIT = int(os.environ.get("FFMPEG_QUEUE_LIMIT", 50))  # Jobs allowed to wait for a slot
+REMUX_COST_FACTOR = 0.05  # Stream copy costs a small fraction of a transcode
+UNKNOWN_JOB_COST = 3600  # Seconds of media assumed when the duration is unknown
+QUEUE_AGING = 10  # Seconds of priority a job gains per second spent waiting
+
+logger = logging.getLogger(__name__)
+
+# Codecs that can be stream-copied into each output container as-is
+REMUX_VIDEO_CODECS = {'mp4': {'h264'}}
+REMUX_AUDIO_CODECS = {'mp4': {'aac'}, 'mp3': {'mp3'}}
+
+async def probe_media(input_file, data=None):
+    """Return codec names and duration of a media file via ffprobe.
+
+    With `data`, the bytes are piped to ffprobe and `input_file` should be 'pipe:0'.
+    """
+    cmd = [
+        'ffprobe', '-v', 'error',
+        '-show_entries', 'stream=codec_type,codec_name:format=duration',
+        '-of', 'json',
+        input_file
+    ]
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.PIPE if data is not None else asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await process.communicate(data)
+    if process.returncode != 0:
+        raise Exception(f"ffprobe failed: {stderr.decode(errors='replace').strip()}")
+
+    data = json.loads(stdout or b'{}')
+    info = {'video': None, 'audio': None, 'duration': None}
+    for stream in data.get('streams', []):
+        codec_type = stream.get('codec_type')
+        if codec_type in ('video', 'audio') and info[codec_type] is None:
+            info[codec_type] = stream.get('codec_name')
+    try:
+        info['duration'] = float(data.get('format', {}).get('duration'))
+    except (TypeError, ValueError):
+        pass
+    return info
+
+def can_remux(info, output_format):
+    """Whether probed streams fit the output container without re-encoding"""
+    audio_ok = info['audio'] is None or info['audio'] in REMUX_AUDIO_CODECS.get(output_format, set())
+    if output_format == 'mp3':
+        return info['audio'] is not None and audio_ok
+    video_ok = info['video'] is not None and info['video'] in REMUX_VIDEO_CODECS.get(output_format, set())
+    return video_ok and audio_ok
+
+class FfmpegScheduler:
+    """Process-wide gate for ffmpeg runs.
+
+    Keeps at most `slots` conversions running, each limited to `threads`
+    encoder threads, and hands free slots to the cheapest waiting job first.
+    Waiting jobs age so long conversions can't starve behind a stream of
+    short ones. Raises when more than `max_queue` jobs are already waiting.
+
+    Piped conversions run at download speed and would hold a slot for the
+    whole download (hours for a live recording), so they don't take one;
+    they are only counted in `piped`.
+    """
+
+    def __init__(self, slots=FFMPEG_SLOTS, threads=FFMPEG_THREADS, max_queue=FFMPEG_QUEUE_LIMIT):
+        self.slots = slots
+        self.threads = threads
+        self.max_queue = max_queue
+        self.active = 0
+        self.piped = 0
+        self.waiting = []
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _dispatch(self):
+        now = time.time()
+        while self.waiting and self.active < self.slots:
+            job = min(self.waiting, key=lambda j: j[0] - QUEUE_AGING * (now - j[1]))
+            self.waiting.remove(job)
+            if not job[2].done():
+                self.active += 1
+                job[2].set_result(None)
+
+    async def acquire(self, cost=None):
+        """Wait for a slot; `cost` is the expected seconds of work"""
+        if len(self.waiting) >= self.max_queue:
+            raise Exception(f"Conversion queue is full ({len(self.waiting)} waiting)")
+        job = (UNKNOWN_JOB_COST if cost is None else cost, time.time(), asyncio.get_running_loop().create_future())
+        self.waiting.append(job)
+        self._dispatch()
+        try:
+            await job[2]
+        except BaseException:
+            if job in self.waiting:
+                self.waiting.remove(job)
+            elif job[2].done() and not job[2].cancelled():
+                self.release()
+            raise
+
+        waited = time.time() - job[1]
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        if waited >= 1:
+            logger.info(f"Waited {waited:.1f}s for an ffmpeg slot ({self.stats()})")
+        return waited
+
+    def release(self):
+        self.active -= 1
+        self.completed += 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, cost=None):
+        await self.acquire(cost)
+        try:
+            yield self.threads
+        finally:
+            self.release()
+
+    def stats(self):
+        started = self.completed + self.active
+        return {
+            'slots': self.slots,
+            'threads_per_slot': self.threads,
+            'active': self.active,
+            'piped': self.piped,
+            'queued': len(self.waiting),
+            'completed': self.completed,
+            'avg_wait': self.total_wait / started if started else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+scheduler = FfmpegScheduler()
+
+def job_cost(duration, remux):
+    """Expected work for a conversion, used to run short jobs first"""
+    if duration is None:
+        return None
+    return duration * (REMUX_COST_FACTOR if remux else 1)
+
+def build_convert_cmd(input_file, output_file, output_format, remux=False, threads=FFMPEG_THREADS,
+                      progress=False):
+    """Build the ffmpeg command line for converting to `output_format`.
+
+    With `progress`, ffmpeg reports key=value progress lines on stdout.
+    """
+    if output_format == 'mp3' and remux:
+        # Source audio is already MP3, just drop the video
+        args = [
+            '-vn',
+            '-c:a', 'copy',
+        ]
+    elif output_format == 'mp4' and remux:
+        # H.264/AAC source: stream-copy into MP4 instead of re-encoding
+        args = [
+            '-map', '0:v?', '-map', '0:a?',  # Skip data streams MP4 can't hold
+            '-c', 'copy',
+            '-bsf:a', 'aac_adtstoasc',  # ADTS AAC from TS -> MP4 AAC
+            '-movflags', '+faststart',  # Enable streaming
+        ]
+    elif output_format == 'mp3':
+        # Fast MP3 extraction with optimal settings
+        args = [
+            '-vn',  # No video
+            '-acodec', 'libmp3lame',
+            '-ab', '128k',  # Reduced bitrate for faster encoding
+            '-ar', '44100',
+            '-ac', '2',  # Stereo
+            '-threads', str(threads),  # Share cores with the other ffmpeg slots
+        ]
+    elif output_format == 'mp4':
+        # Optimized MP4 for streaming with fast encoding
+        args = [
+            '-c:v', 'libx264',
+            '-preset', 'ultrafast',  # Fastest encoding preset
+            '-crf', '28',  # Reasonable quality with fast encoding
+            '-profile:v', 'baseline',  # Better compatibility
+            '-level', '3.1',
+            '-c:a', 'aac',
+            '-b:a', '128k',
+            '-ac', '2',
+            '-movflags', '+faststart',  # Enable streaming
+            '-threads', str(threads),  # Share cores with the other ffmpeg slots
+        ]
+    else:
+        # Copy streams for other formats (fastest)
+        args = [
+            '-c', 'copy',
+            '-movflags', '+faststart',  # Enable streaming if container supports it
+            '-threads', str(threads),
+        ]
+    progress_args = ['-progress', 'pipe:1'] if progress else []
+    return ['ffmpeg', '-nostats', *progress_args, '-i', input_file, *args, '-y', output_file]
+
+async def drain_stderr(stream, tail):
+    """Consume ffmpeg stderr so the pipe never fills, keeping only the last lines"""
+    pending = b''
+    while True:
+        chunk = await stream.read(64 * 1024)
+        if not chunk:
+            break
+        *lines, pending = (pending + chunk).split(b'\n')
+        # Cap a runaway line instead of letting it grow unbounded
+        pending = pending[-4096:]
+        tail.extend(line.decode(errors='replace').rstrip()[-4096:] for line in lines)
+    if pending:
+        tail.append(pending.decode(errors='replace').rstrip())
+
+async def run_ffmpeg(cmd, duration=None, progress_callback=None):
+    """Run ffmpeg to completion and return (returncode, stderr tail).
+
+    `progress_callback(seconds_done, duration)` is awaited for every
+    out_time_ms report of a command built with progress=True. stderr is
+    drained as it arrives so multi-hour inputs don't pile up in memory.
+    """
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    tail = deque(maxlen=STDERR_TAIL_LINES)
+    stderr_task = asyncio.create_task(drain_stderr(process.stderr, tail))
+    try:
+        while True:
+            line = await process.stdout.readline()
+            if not line:
+                break
+            key, _, value = line.decode(errors='replace').strip().partition('=')
+            # out_time_ms is in microseconds despite its name; N/A before the first frame
+            if key == 'out_time_ms' and value.isdigit() and progress_callback:
+                try:
+                    await progress_callback(int(value) / 1_000_000, duration)
+                except Exception as e:
+                    logger.error(f"Conversion progress error: {str(e)}")
+        await process.wait()
+        await stderr_task
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        stderr_task.cancel()
+        raise
+    return process.returncode, '\n'.join(tail)
+
+class FfmpegPipeSink:
+    """Feed ordered segment bytes into ffmpeg's stdin while it writes the final file.
+
+    Drop-in for SegmentSink in process_m3u8. A pipe can't be rewound, so each
+    segment is collected whole before it is written. ffmpeg is started on the
+    first segment, which is also probed to decide between remux and transcode.
+    """
+
+    def __init__(self, output_file, output_format):
+        self.output_file = output_file
+        self.output_format = output_format
+        self.process = None
+        self.stderr_task = None
+        self.stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+        self.bytes_written = 0
+        self.failed = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.process is None:
+            return
+        try:
+            await self.finish(exc_type is not None)
+        finally:
+            scheduler.piped -= 1
+
+    async def finish(self, failed):
+        if failed:
+            self.process.kill()
+            await self.process.wait()
+            await self.stderr_task
+            if os.path.exists(self.output_file):
+                os.remove(self.output_file)
+            return
+
+        self.process.stdin.close()
+        await self.process.wait()
+        await self.stderr_task
+        if self.process.returncode != 0:
+            stderr = '\n'.join(self.stderr_tail)
+            logger.error(f"FFmpeg error: {stderr}")
+            raise Exception(f"ffmpeg exited with code {self.process.returncode}")
+
+    def rollback(self, idx):
+        """Nothing to roll back, piped jobs are not resumable"""
+
+    async def start(self, first_segment):
+        try:
+            remux = can_remux(await probe_media('pipe:0', first_segment), self.output_format)
+        except Exception as e:
+            logger.error(f"Probe failed, falling back to transcoding: {str(e)}")
+            remux = False
+        # No scheduler slot: ffmpeg mostly waits on the download here
+        cmd = build_convert_cmd('pipe:0', self.output_file, self.output_format, remux, scheduler.threads)
+        logger.info(f"Starting piped conversion with command: {' '.join(cmd)}")
+        self.process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE
+        )
+        scheduler.piped += 1
+        self.stderr_task = asyncio.create_task(drain_stderr(self.process.stderr, self.stderr_tail))
+
+    async def write_segment(self, idx, chunks):
+        """Collect one segment and pipe it into ffmpeg"""
+        buffer = []
+        try:
+            async for chunk in chunks:
+                if chunk is SEGMENT_RESTART:
+                    buffer.clear()
+                    continue
+                buffer.append(chunk)
+        except Exception as e:
+            logger.error(f"Segment download error: {str(e)}")
+            self.failed.append(idx)
+            return False
+
+        data = b''.join(buffer)
+        if self.process is None:
+            await self.start(data)
+        self.process.stdin.write(data)
+        await self.process.stdin.drain()
+        self.bytes_written += len(data)
+        return True
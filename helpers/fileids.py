@@ -0,0 +1,86 @@
+import os
+import time
+import sqlite3
+import logging
+from pyrogram.errors import FloodWait
+
+# Constants
+FILE_ID_DB = os.environ.get("FILE_ID_DB", "file_ids.db")
+MEDIA_ATTRIBUTES = ('video', 'document', 'audio', 'animation')
+
+logger = logging.getLogger(__name__)
+
+def sent_file_id(sent):
+    """file_id of the media in a message we just sent, None if it has none"""
+    for attr in MEDIA_ATTRIBUTES:
+        media = getattr(sent, attr, None) if sent else None
+        if media:
+            return media.file_id
+    return None
+
+class FileIdStore:
+    """Persistent content key -> Telegram file_id map.
+
+    Once a file has been delivered, Telegram can resend it by file_id
+    without the bot downloading, converting or uploading anything again.
+    file_ids are only valid for the bot that uploaded them; ones Telegram
+    rejects are dropped and the content is fetched again.
+    """
+
+    def __init__(self, path=FILE_ID_DB):
+        self.path = path
+        self.db = None
+        self.hits = 0
+
+    def _connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS file_ids ("
+                "key TEXT PRIMARY KEY, file_id TEXT NOT NULL, created_at REAL, used_at REAL)"
+            )
+        return self.db
+
+    def get(self, key):
+        row = self._connect().execute("SELECT file_id FROM file_ids WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, key, sent):
+        """Remember the file_id of a message we just sent for `key`"""
+        file_id = sent_file_id(sent)
+        if not file_id:
+            return
+        now = time.time()
+        with self._connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO file_ids (key, file_id, created_at, used_at) VALUES (?, ?, ?, ?)",
+                (key, file_id, now, now)
+            )
+
+    def forget(self, key):
+        with self._connect() as db:
+            db.execute("DELETE FROM file_ids WHERE key = ?", (key,))
+
+    async def send(self, message, key, caption=""):
+        """Resend the media stored for `key` as a reply; None if there is nothing usable"""
+        file_id = self.get(key)
+        if not file_id:
+            return None
+        try:
+            sent = await message.reply_cached_media(file_id, caption=caption)
+        except FloodWait:
+            raise
+        except Exception as e:
+            logger.error(f"Cached file_id for {key} rejected, fetching again: {str(e)}")
+            self.forget(key)
+            return None
+        with self._connect() as db:
+            db.execute("UPDATE file_ids SET used_at = ? WHERE key = ?", (time.time(), key))
+        self.hits += 1
+        return sent
+
+    def count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM file_ids").fetchone()[0]
+
+file_ids = FileIdStore()
@@ -0,0 +1,519 @@
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+import m3u8
+import aiohttp
+import aiofiles
+from collections import deque
+from email.utils import parsedate_to_datetime
+from urllib.parse import urljoin
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+# Constants
+MAX_CONCURRENT_DOWNLOADS = 5  # Segment requests in flight per job
+REORDER_BUFFER_FACTOR = 2  # Finished-but-unwritten segments kept per in-flight slot
+CHUNK_SIZE = 1024 * 1024  # 1 MB
+MANIFEST_SAVE_INTERVAL = 5  # Seconds between manifest checkpoints
+SEGMENT_RETRIES = 4  # Extra attempts per segment after the first one
+RETRY_BASE_DELAY = 1  # Seconds, doubled on every attempt
+RETRY_MAX_DELAY = 30  # Upper bound for a single backoff
+MAX_RETRY_AFTER = 120  # Never honour a Retry-After longer than this
+SEGMENT_FAILURE_BUDGET = 2  # Segments a job may lose before it is aborted
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+# A stalled segment is retried sooner than the shared session's default would give up
+SEGMENT_TIMEOUT = aiohttp.ClientTimeout(total=None, connect=10, sock_connect=10, sock_read=10)
+LIVE_MAX_SECONDS = int(os.environ.get("LIVE_MAX_MINUTES", 120)) * 60  # Longest recording of a live stream
+LIVE_STALE_POLLS = 5  # Refreshes in a row without new segments before a live stream counts as over
+DEFAULT_TARGET_DURATION = 6  # Seconds between refreshes when a playlist doesn't say
+
+logger = logging.getLogger(__name__)
+
+# Headers for requests
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    'Accept': '*/*',
+}
+
+# Marker telling the writer to discard a partially streamed segment
+SEGMENT_RESTART = object()
+
+class SegmentError(Exception):
+    """A segment request failed; carries the HTTP status and any Retry-After"""
+
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self):
+        return self.status is None or self.status in RETRYABLE_STATUSES
+
+class FetchStats:
+    """Per-job counters for segment downloads"""
+
+    def __init__(self):
+        self.segments = 0
+        self.failed = 0
+        self.retries = 0
+        self.latencies = []
+
+    def summary(self):
+        if self.latencies:
+            latencies = sorted(self.latencies)
+            avg = sum(latencies) / len(latencies)
+            p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            timing = f"latency avg {avg:.2f}s / p95 {p95:.2f}s / max {latencies[-1]:.2f}s"
+        else:
+            timing = "no latency samples"
+        return (
+            f"{self.segments} segments, {self.failed} failed, "
+            f"{self.retries} retries, {timing}"
+        )
+
+def parse_retry_after(value):
+    """Parse a Retry-After header given in seconds or as an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+def backoff_delay(attempt, retry_after=None):
+    """Full-jitter exponential backoff, stretched to honour Retry-After"""
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, MAX_RETRY_AFTER))
+    return delay
+
+class KeyCache:
+    """Fetch each segment key once per job, however many segments share it"""
+
+    def __init__(self, session):
+        self.session = session
+        self.keys = {}
+
+    async def get(self, uri):
+        if uri not in self.keys:
+            self.keys[uri] = asyncio.ensure_future(self._fetch(uri))
+        try:
+            return await asyncio.shield(self.keys[uri])
+        except Exception:
+            # Let the next segment retry the key instead of caching the failure
+            self.keys.pop(uri, None)
+            raise
+
+    async def _fetch(self, uri):
+        async with self.session.get(uri, headers=HEADERS) as response:
+            if response.status != 200:
+                raise SegmentError(
+                    f"Key fetch failed: HTTP {response.status}",
+                    status=response.status,
+                    retry_after=parse_retry_after(response.headers.get('Retry-After'))
+                )
+            key = await response.read()
+        if len(key) != 16:
+            raise Exception(f"Invalid AES-128 key from {uri} ({len(key)} bytes)")
+        return key
+
+def segment_key(segment, media_sequence, base_url):
+    """Return (key uri, iv) for an AES-128 segment, None if it is not encrypted"""
+    key = segment.key
+    if key is None or not key.method or key.method == 'NONE':
+        return None
+    if key.method != 'AES-128':
+        # SAMPLE-AES encrypts individual samples inside the TS and can't be
+        # undone on whole segments; fail before downloading anything
+        raise Exception(f"Unsupported playlist encryption: {key.method}")
+    if key.iv:
+        iv = bytes.fromhex(key.iv[2:] if key.iv.lower().startswith('0x') else key.iv).rjust(16, b'\0')
+    else:
+        # No explicit IV: the media sequence number is used, big-endian
+        iv = media_sequence.to_bytes(16, 'big')
+    return urljoin(base_url, key.uri), iv
+
+def decrypt_segment(data, key, iv):
+    """AES-128-CBC decrypt a whole segment and strip PKCS#7 padding"""
+    decryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+    plain = decryptor.update(data) + decryptor.finalize()
+    unpadder = padding.PKCS7(128).unpadder()
+    try:
+        return unpadder.update(plain) + unpadder.finalize()
+    except ValueError:
+        # Some packagers don't pad; keep the raw plaintext
+        return plain
+
+VIDEO_CODEC_PREFIXES = ('avc', 'hvc', 'hev', 'vp0', 'vp9', 'av01', 'mp4v')
+
+def is_audio_only(variant):
+    """True for a variant whose CODECS list no video codec; without CODECS we can't tell"""
+    codecs = variant.stream_info.codecs
+    if not codecs:
+        return False
+    return not any(codec.strip().startswith(VIDEO_CODEC_PREFIXES) for codec in codecs.split(','))
+
+def variant_label(audio_only=False, height=None):
+    """Which rendition a job wants, as used in cache keys"""
+    if audio_only:
+        return 'audio'
+    return f"{height}p" if height else 'best'
+
+def select_variant(playlist, audio_only=False, height=None):
+    """Pick the rendition of a master playlist a job needs; returns (uri, bandwidth or None).
+
+    Audio jobs take an audio-only rendition when there is one, otherwise the
+    cheapest variant. Video jobs take the best variant no taller than
+    `height` (the smallest one if none is), or simply the best without it.
+    """
+    variants = [variant for variant in playlist.playlists if variant.stream_info]
+    bandwidth = lambda variant: variant.stream_info.bandwidth or 0
+
+    if audio_only:
+        renditions = [media for media in playlist.media if media.type == 'AUDIO' and media.uri]
+        if renditions:
+            rendition = next((media for media in renditions if media.default == 'YES'), renditions[0])
+            return rendition.uri, None
+        audio_variants = [variant for variant in variants if is_audio_only(variant)]
+        if audio_variants:
+            variant = max(audio_variants, key=bandwidth)
+        else:
+            variant = min(variants, key=bandwidth)
+        return variant.uri, variant.stream_info.bandwidth
+
+    video_variants = [variant for variant in variants if not is_audio_only(variant)] or variants
+    if height:
+        fitting = [
+            variant for variant in video_variants
+            if variant.stream_info.resolution and variant.stream_info.resolution[1] <= height
+        ]
+        if fitting:
+            variant = max(fitting, key=bandwidth)
+        else:
+            # Nothing is that small: the closest is the smallest there is
+            variant = min(video_variants, key=lambda v: ((v.stream_info.resolution or (0, 0))[1], bandwidth(v)))
+    else:
+        variant = max(video_variants, key=bandwidth)
+    return variant.uri, variant.stream_info.bandwidth
+
+class LivePlaylist:
+    """Follow a live or EVENT media playlist as it grows.
+
+    The playlist is refetched every target duration with If-None-Match /
+    If-Modified-Since, so an unchanged playlist costs a 304. Segments are
+    deduplicated by media sequence number and handed out once each, numbered
+    from 1, until EXT-X-ENDLIST appears, `max_seconds` of media has been
+    handed out, or the playlist stops growing.
+    """
+
+    def __init__(self, session, url, playlist, max_seconds=LIVE_MAX_SECONDS):
+        self.session = session
+        self.url = url
+        self.base_url = url.rsplit('/', 1)[0] + '/'
+        self.playlist = playlist
+        self.max_seconds = max_seconds
+        self.etag = None
+        self.last_modified = None
+        self.last_sequence = None
+        self.count = 0
+        self.seconds = 0.0
+        self.refreshes = 0
+        self.not_modified = 0
+        self.ended = False
+
+    def _take_new(self, playlist):
+        first = playlist.media_sequence or 0
+        batch = []
+        for offset, segment in enumerate(playlist.segments):
+            sequence = first + offset
+            if self.last_sequence is not None and sequence <= self.last_sequence:
+                continue
+            if self.seconds >= self.max_seconds:
+                logger.info(f"Live recording of {self.url} reached its {self.max_seconds}s cap")
+                self.ended = True
+                break
+            self.count += 1
+            batch.append((self.count, urljoin(self.base_url, segment.uri), segment_key(segment, sequence, self.base_url)))
+            self.seconds += segment.duration or 0
+            self.last_sequence = sequence
+        if playlist.is_endlist:
+            self.ended = True
+        return batch
+
+    async def _refresh(self):
+        headers = dict(HEADERS)
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        self.refreshes += 1
+        async with self.session.get(self.url, headers=headers) as response:
+            if response.status == 304:
+                self.not_modified += 1
+                return None
+            if response.status != 200:
+                raise SegmentError(f"Playlist refresh failed: HTTP {response.status}", status=response.status)
+            self.etag = response.headers.get('ETag')
+            self.last_modified = response.headers.get('Last-Modified')
+            return m3u8.loads(await response.text())
+
+    async def batches(self):
+        """Yield lists of new (index, url, key) segments as the playlist grows"""
+        batch = self._take_new(self.playlist)
+        stale = 0
+        while True:
+            if batch:
+                yield batch
+            if self.ended:
+                return
+            await asyncio.sleep(self.playlist.target_duration or DEFAULT_TARGET_DURATION)
+            try:
+                playlist = await self._refresh()
+            except (SegmentError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f"Live playlist refresh of {self.url} failed: {str(e)}")
+                playlist = None
+            if playlist:
+                self.playlist = playlist
+            batch = self._take_new(playlist) if playlist else []
+            stale = 0 if batch else stale + 1
+            if stale >= LIVE_STALE_POLLS:
+                logger.info(f"Live playlist {self.url} stopped updating, ending the recording")
+                return
+
+def manifest_path(output_file):
+    """Path of the resume manifest kept next to a job's output file"""
+    return f"{output_file}.manifest.json"
+
+def load_manifest(output_file, url, variant_url):
+    """Load the resume manifest for a job if it matches this playlist"""
+    path = manifest_path(output_file)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.error(f"Ignoring unreadable manifest {path}: {str(e)}")
+        return None
+
+    if manifest.get('url') != url or manifest.get('variant_url') != variant_url:
+        logger.info(f"Manifest {path} belongs to another playlist, starting over")
+        return None
+    manifest['segments'] = {int(idx): offsets for idx, offsets in manifest.get('segments', {}).items()}
+    return manifest
+
+def save_manifest(output_file, manifest):
+    """Atomically write the resume manifest for a job"""
+    path = manifest_path(output_file)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+def remove_manifest(output_file):
+    """Drop a job's resume manifest once it is no longer needed"""
+    path = manifest_path(output_file)
+    if os.path.exists(path):
+        os.remove(path)
+
+def resume_point(manifest):
+    """Return (next segment index, byte offset) to continue a job from"""
+    if not manifest or not manifest['segments']:
+        return 1, 0
+    last_idx = max(manifest['segments'])
+    return last_idx + 1, manifest['segments'][last_idx][1]
+
+class SegmentSink:
+    """Append-only job output that keeps one file handle open for the whole job"""
+
+    def __init__(self, path, manifest=None):
+        self.path = path
+        self.file = None
+        self.bytes_written = 0
+        self.offset = 0  # Where the next segment starts; truncate() doesn't move the stream
+        self.manifest = manifest
+        self.last_checkpoint = 0
+        self.failed = []
+
+    async def __aenter__(self):
+        self.file = await aiofiles.open(self.path, 'ab')
+        self.offset = await self.file.tell()
+        if self.manifest is not None:
+            # Drop anything written after the last checkpoint; new segments are recorded from there
+            _, offset = resume_point(self.manifest)
+            await self._truncate(offset)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.checkpoint(force=True)
+        await self.file.close()
+
+    async def checkpoint(self, force=False):
+        """Persist finished segments to the manifest, at most every few seconds"""
+        if self.manifest is None:
+            return
+        now = time.time()
+        if not force and now - self.last_checkpoint < MANIFEST_SAVE_INTERVAL:
+            return
+        await self.file.flush()
+        save_manifest(self.path, self.manifest)
+        self.last_checkpoint = now
+
+    async def tell(self):
+        return self.offset
+
+    async def _truncate(self, offset):
+        """Cut the file back to `offset` and continue writing from there"""
+        await self.file.truncate(offset)
+        await self.file.seek(offset)
+        self.offset = offset
+
+    def rollback(self, idx):
+        """Forget segment `idx` and everything after it so a resume refetches them"""
+        if self.manifest is not None:
+            self.manifest['segments'] = {
+                i: offsets for i, offsets in self.manifest['segments'].items() if i < idx
+            }
+
+    async def write_segment(self, idx, chunks):
+        """Stream one segment's chunks to disk, rolling back on failure"""
+        start = self.offset
+        written = 0
+        try:
+            async for chunk in chunks:
+                if chunk is SEGMENT_RESTART:
+                    # The fetch is being retried, drop what it streamed so far
+                    await self._truncate(start)
+                    written = 0
+                    continue
+                await self.file.write(chunk)
+                written += len(chunk)
+                self.offset += len(chunk)
+        except Exception as e:
+            logger.error(f"Segment download error: {str(e)}")
+            await self._truncate(start)
+            self.failed.append(idx)
+            return False
+        self.bytes_written += written
+        if self.manifest is not None:
+            self.manifest['segments'][idx] = [start, start + written]
+            await self.checkpoint()
+        return True
+
+async def _drain(queue):
+    """Yield chunks pushed by a segment fetch until it finishes or fails"""
+    while True:
+        item = await queue.get()
+        if item is None:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+async def fetch_segments_ordered(session, segments, concurrency=MAX_CONCURRENT_DOWNLOADS,
+                                 buffer_size=None, retries=SEGMENT_RETRIES, stats=None, keys=None):
+    """Fetch (index, url, key) segments concurrently and yield (index, chunks) in order.
+
+    `chunks` is an async iterator over the segment body; the head of the
+    window streams straight through while later segments buffer behind it.
+    At most `concurrency` requests are in flight and at most `buffer_size`
+    segments are buffered, so memory stays flat on very long playlists.
+    Failed requests are retried with jittered exponential backoff; a retry
+    emits SEGMENT_RESTART first so the writer can drop partial data.
+    Encrypted segments (key = (key uri, iv)) are buffered whole and
+    decrypted on a worker thread, with keys fetched once through a KeyCache;
+    pass `keys` to share one across calls (e.g. live playlist refreshes).
+    Iterating `chunks` raises once a segment runs out of attempts.
+    """
+    if buffer_size is None:
+        buffer_size = concurrency * REORDER_BUFFER_FACTOR
+    buffer_size = max(buffer_size, concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+    if stats is None:
+        stats = FetchStats()
+    if keys is None:
+        keys = KeyCache(session)
+
+    async def fetch_once(url, key, queue):
+        async with semaphore:
+            # Timed from here so waiting for a slot in the window doesn't count as latency
+            started = time.time()
+            async with session.get(url, headers=HEADERS, timeout=SEGMENT_TIMEOUT) as response:
+                if response.status != 200:
+                    raise SegmentError(
+                        f"HTTP {response.status}",
+                        status=response.status,
+                        retry_after=parse_retry_after(response.headers.get('Retry-After'))
+                    )
+                if key is None:
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        queue.put_nowait(chunk)
+                    stats.latencies.append(time.time() - started)
+                    return
+                data = await response.read()
+            stats.latencies.append(time.time() - started)
+        key_uri, iv = key
+        key_bytes = await keys.get(key_uri)
+        queue.put_nowait(await asyncio.to_thread(decrypt_segment, data, key_bytes, iv))
+
+    async def fetch(url, key, queue):
+        stats.segments += 1
+        for attempt in range(retries + 1):
+            try:
+                await fetch_once(url, key, queue)
+                queue.put_nowait(None)
+                return
+            except (SegmentError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if not isinstance(e, SegmentError):
+                    e = SegmentError(f"{type(e).__name__}: {str(e)}")
+                if attempt == retries or not e.retryable:
+                    stats.failed += 1
+                    queue.put_nowait(e)
+                    return
+                delay = backoff_delay(attempt, e.retry_after)
+                logger.warning(f"Segment {url} failed ({str(e)}), retry {attempt + 1}/{retries} in {delay:.1f}s")
+                stats.retries += 1
+                queue.put_nowait(SEGMENT_RESTART)
+                await asyncio.sleep(delay)
+            except Exception as e:
+                stats.failed += 1
+                queue.put_nowait(e)
+                return
+
+    remaining = iter(segments)
+    window = deque()
+
+    def schedule_next():
+        item = next(remaining, None)
+        if item is not None:
+            idx, url, key = item
+            queue = asyncio.Queue()
+            window.append((idx, queue, asyncio.create_task(fetch(url, key, queue))))
+
+    head = None
+    try:
+        for _ in range(buffer_size):
+            schedule_next()
+
+        while window:
+            idx, queue, head = window.popleft()
+            # Refill the window before handing the head to the writer
+            schedule_next()
+            yield idx, _drain(queue)
+            await head
+    finally:
+        # The head left the window before it was yielded, so stop it along with the rest
+        tasks = [task for _, _, task in window]
+        if head is not None:
+            tasks.append(head)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
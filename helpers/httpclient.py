@@ -0,0 +1,107 @@
+import os
+import logging
+import aiohttp
+
+# Constants
+HTTP_POOL_LIMIT = int(os.environ.get("HTTP_POOL_LIMIT", 100))  # Connections open at once across all hosts
+HTTP_PER_HOST_LIMIT = int(os.environ.get("HTTP_PER_HOST_LIMIT", 20))  # Connections to a single CDN host
+DNS_CACHE_TTL = 300  # Seconds a resolved host is reused
+KEEPALIVE_TIMEOUT = 60  # Seconds an idle connection is kept for the next request
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=None, connect=10, sock_connect=10, sock_read=30)
+
+logger = logging.getLogger(__name__)
+
+class PoolStats:
+    """Connection reuse and DNS cache counters, fed by aiohttp's tracing hooks"""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.queued = 0
+        self.dns_hits = 0
+        self.dns_misses = 0
+
+    def trace_config(self):
+        trace = aiohttp.TraceConfig()
+
+        def count(attr):
+            async def hook(session, context, params):
+                setattr(self, attr, getattr(self, attr) + 1)
+            return hook
+
+        trace.on_request_start.append(count('requests'))
+        trace.on_request_exception.append(count('errors'))
+        trace.on_connection_create_end.append(count('connections_created'))
+        trace.on_connection_reuseconn.append(count('connections_reused'))
+        trace.on_connection_queued_start.append(count('queued'))
+        trace.on_dns_cache_hit.append(count('dns_hits'))
+        trace.on_dns_cache_miss.append(count('dns_misses'))
+        return trace
+
+class HttpClient:
+    """The one aiohttp session every plugin downloads through.
+
+    It lives as long as the bot does, so connections to a CDN host are
+    kept alive and reused between segments, entries and jobs instead of
+    paying a TCP and TLS handshake each time. Resolved hosts are cached
+    for DNS_CACHE_TTL. Per-request concurrency is still bounded by the
+    callers (segment and PDF semaphores); the connector only caps the
+    totals.
+    """
+
+    def __init__(self):
+        self.session = None
+        self.counters = PoolStats()
+
+    async def start(self):
+        if self.session is not None and not self.session.closed:
+            return self.session
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_PER_HOST_LIMIT,
+            use_dns_cache=True,
+            ttl_dns_cache=DNS_CACHE_TTL,
+            keepalive_timeout=KEEPALIVE_TIMEOUT
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=HTTP_TIMEOUT,
+            trace_configs=[self.counters.trace_config()]
+        )
+        logger.info(
+            f"HTTP pool ready: {HTTP_POOL_LIMIT} connections, {HTTP_PER_HOST_LIMIT} per host, "
+            f"DNS cached for {DNS_CACHE_TTL}s"
+        )
+        return self.session
+
+    async def get_session(self):
+        """The shared session, created on first use if startup didn't"""
+        return await self.start()
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    def stats(self):
+        counters = self.counters
+        connector = self.session.connector if self.session is not None and not self.session.closed else None
+        # aiohttp has no public pool accessors; these are the connector's own bookkeeping
+        idle = sum(len(conns) for conns in getattr(connector, '_conns', {}).values()) if connector else 0
+        in_use = len(getattr(connector, '_acquired', ())) if connector else 0
+        return {
+            'requests': counters.requests,
+            'errors': counters.errors,
+            'created': counters.connections_created,
+            'reused': counters.connections_reused,
+            'queued': counters.queued,
+            'dns_hits': counters.dns_hits,
+            'dns_misses': counters.dns_misses,
+            'in_use': in_use,
+            'idle': idle,
+            'limit': HTTP_POOL_LIMIT,
+        }
+
+http_client = HttpClient()
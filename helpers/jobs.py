@@ -0,0 +1,271 @@
+import os
+import time
+import asyncio
+import logging
+import itertools
+import threading
+import contextvars
+from collections import deque
+from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from helpers.workspace import workspaces
+
+# Constants
+MAX_ACTIVE_JOBS = int(os.environ.get("MAX_ACTIVE_JOBS", 3))  # Jobs running at once across all users
+MAX_JOBS_PER_USER = int(os.environ.get("MAX_JOBS_PER_USER", 1))  # Jobs one user may have running
+MAX_QUEUED_JOBS = int(os.environ.get("MAX_QUEUED_JOBS", 50))  # Waiting jobs before new ones are refused
+MAX_QUEUED_PER_USER = 5  # Waiting jobs one user may have
+DEFAULT_JOB_SECONDS = 300  # Duration guess until real jobs have finished
+DURATION_SMOOTHING = 0.2  # Weight of the newest job in the running average
+
+logger = logging.getLogger(__name__)
+
+# Job whose task (or worker thread) is running the current code
+current_job = contextvars.ContextVar('current_job', default=None)
+job_ids = itertools.count(1)
+
+class QueueFull(Exception):
+    """Raised when a job is refused; carries where it would have landed"""
+
+    def __init__(self, message, position=None, eta=None):
+        super().__init__(message)
+        self.position = position
+        self.eta = eta
+
+class JobCancelled(Exception):
+    """Raised inside worker threads (e.g. yt-dlp hooks) once their job is cancelled"""
+
+class Job:
+    """One queued unit of work for a user"""
+
+    def __init__(self, user_id, label, run):
+        self.id = next(job_ids)
+        self.user_id = user_id
+        self.label = label
+        self.run = run
+        self.submitted = time.time()
+        self.started = None
+        self.task = None
+        self.cancelled = threading.Event()
+        self.temp_files = set()
+
+    def cancel(self):
+        self.cancelled.set()
+        if self.task:
+            self.task.cancel()
+
+    def cleanup(self):
+        """Remove every temp file the job registered"""
+        for path in self.temp_files:
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except Exception as e:
+                logger.error(f"Cleanup error: {str(e)}")
+        self.temp_files.clear()
+
+def track_temp(*paths):
+    """Register files of the current job to delete if it gets cancelled"""
+    job = current_job.get()
+    if job:
+        job.temp_files.update(path for path in paths if path)
+
+def check_cancelled():
+    """Raise JobCancelled if the current job was cancelled; for code outside the event loop"""
+    job = current_job.get()
+    if job and job.cancelled.is_set():
+        raise JobCancelled(f"Job {job.label} was cancelled")
+
+def cancel_button(job=None):
+    """Inline keyboard with a Cancel button for `job` (default: the current one)"""
+    job = job or current_job.get()
+    if not job:
+        return None
+    return InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel", callback_data=f"cancel_job:{job.id}")]])
+
+class JobQueue:
+    """Process-wide job scheduler.
+
+    At most `max_active` jobs run at once and at most `per_user` of them
+    belong to the same user. Waiting jobs are handed out round-robin
+    between users, so one user's backlog can't starve everyone else.
+    Jobs run in their own tasks, each with its own work directory;
+    handlers only submit and return. While the disk is short on space,
+    waiting jobs stay queued until a running one finishes.
+    """
+
+    def __init__(self, max_active=MAX_ACTIVE_JOBS, per_user=MAX_JOBS_PER_USER,
+                 max_queued=MAX_QUEUED_JOBS, max_queued_per_user=MAX_QUEUED_PER_USER):
+        self.max_active = max_active
+        self.per_user = per_user
+        self.max_queued = max_queued
+        self.max_queued_per_user = max_queued_per_user
+        self.waiting = {}  # user id -> deque of jobs
+        self.turns = deque()  # users with waiting jobs, next to be served first
+        self.running = []
+        self.avg_duration = DEFAULT_JOB_SECONDS
+        self.completed = 0
+        self.rejected = 0
+
+    @property
+    def queued(self):
+        return sum(len(jobs) for jobs in self.waiting.values())
+
+    def active_for(self, user_id):
+        return sum(1 for job in self.running if job.user_id == user_id)
+
+    def _order(self):
+        """Waiting jobs in the order they are expected to start"""
+        queues = {user_id: list(self.waiting[user_id]) for user_id in self.turns}
+        order = []
+        depth = 0
+        while len(order) < self.queued:
+            for user_id in self.turns:
+                if depth < len(queues[user_id]):
+                    order.append(queues[user_id][depth])
+            depth += 1
+        return order
+
+    def position(self, job):
+        """1-based place of a waiting job, 0 once it is running"""
+        if job.started:
+            return 0
+        return self._order().index(job) + 1
+
+    def eta(self, position):
+        """Rough seconds until the job at `position` starts"""
+        if position <= 0:
+            return 0
+        return position * self.avg_duration / self.max_active
+
+    def submit(self, user_id, label, run):
+        """Queue `run()` for `user_id`; raises QueueFull instead of growing without bound"""
+        queued = self.queued
+        if queued >= self.max_queued:
+            self.rejected += 1
+            raise QueueFull(
+                f"The queue is full ({queued} jobs waiting)",
+                position=queued + 1, eta=self.eta(queued + 1)
+            )
+        if len(self.waiting.get(user_id, ())) >= self.max_queued_per_user:
+            self.rejected += 1
+            raise QueueFull(f"You already have {self.max_queued_per_user} jobs waiting")
+
+        job = Job(user_id, label, run)
+        if user_id not in self.waiting:
+            self.waiting[user_id] = deque()
+            self.turns.append(user_id)
+        self.waiting[user_id].append(job)
+        self._dispatch()
+        return job
+
+    def _dispatch(self):
+        # Each pass serves every user with a free quota once, in turn order
+        for _ in range(len(self.turns)):
+            if len(self.running) >= self.max_active:
+                return
+            if self.running and workspaces.available() <= 0:
+                logger.warning("Low on disk space, holding queued jobs back")
+                return
+            user_id = self.turns[0]
+            self.turns.rotate(-1)
+            if self.active_for(user_id) >= self.per_user:
+                continue
+            job = self.waiting[user_id].popleft()
+            if not self.waiting[user_id]:
+                del self.waiting[user_id]
+                self.turns.remove(user_id)
+            self._start(job)
+            # Removing a user shifted the turns; start over to catch every free slot
+            return self._dispatch()
+
+    def _start(self, job):
+        job.started = time.time()
+        self.running.append(job)
+        job.task = asyncio.create_task(self._run(job))
+
+    async def _run(self, job):
+        current_job.set(job)
+        try:
+            async with workspaces.open(f"job_{job.id}"):
+                await job.run()
+        except (asyncio.CancelledError, JobCancelled):
+            logger.info(f"Job {job.label} for {job.user_id} cancelled")
+            job.cleanup()
+        except Exception as e:
+            logger.error(f"Job {job.label} for {job.user_id} failed: {str(e)}")
+        finally:
+            self.running.remove(job)
+            duration = time.time() - job.started
+            self.avg_duration += DURATION_SMOOTHING * (duration - self.avg_duration)
+            self.completed += 1
+            self._dispatch()
+
+    def get(self, job_id):
+        for job in self.running:
+            if job.id == job_id:
+                return job
+        for user_jobs in self.waiting.values():
+            for job in user_jobs:
+                if job.id == job_id:
+                    return job
+        return None
+
+    def cancel(self, job):
+        """Drop a waiting job or stop a running one"""
+        if job.started:
+            job.cancel()
+            return
+        user_jobs = self.waiting.get(job.user_id)
+        if user_jobs and job in user_jobs:
+            user_jobs.remove(job)
+            if not user_jobs:
+                del self.waiting[job.user_id]
+                self.turns.remove(job.user_id)
+        job.cancelled.set()
+
+    def jobs_for(self, user_id):
+        """(job, position) for every running and waiting job of a user"""
+        jobs = [(job, 0) for job in self.running if job.user_id == user_id]
+        order = self._order()
+        jobs += [(job, order.index(job) + 1) for job in order if job.user_id == user_id]
+        return jobs
+
+    def stats(self):
+        return {
+            'running': len(self.running),
+            'max_active': self.max_active,
+            'queued': self.queued,
+            'max_queued': self.max_queued,
+            'users': len(self.turns),
+            'avg_duration': self.avg_duration,
+            'completed': self.completed,
+            'rejected': self.rejected,
+        }
+
+jobs = JobQueue()
+
+def format_eta(seconds):
+    """Short human wait estimate"""
+    minutes = int(seconds // 60)
+    return f"~{minutes} min" if minutes else "<1 min"
+
+async def enqueue(message, user_id, label, run):
+    """Submit a job for a chat message and tell the user where it stands"""
+    try:
+        job = jobs.submit(user_id, label, run)
+    except QueueFull as e:
+        text = f"🚦 {str(e)}, please try again later."
+        if e.position:
+            text += f"\nYou would be #{e.position}, {format_eta(e.eta)} wait."
+        await message.reply_text(text)
+        return None
+
+    position = jobs.position(job)
+    if position:
+        await message.reply_text(
+            f"⏳ Queued: {label}\n"
+            f"Position #{position}, {format_eta(jobs.eta(position))} wait.\n"
+            f"Use /queue to check on it.",
+            reply_markup=cancel_button(job)
+        )
+    return job
@@ -0,0 +1,96 @@
+import os
+import asyncio
+import logging
+import aiofiles
+from helpers.hls import HEADERS, CHUNK_SIZE
+
+# Constants
+PDF_PREFETCH_CONCURRENCY = int(os.environ.get("PDF_PREFETCH_CONCURRENCY", 3))  # PDF downloads in flight per batch
+PDF_MAGIC = b'%PDF-'
+PDF_HEADER_WINDOW = 1024  # Readers accept the %PDF- header anywhere in the first KB
+
+logger = logging.getLogger(__name__)
+
+async def download_pdf(session, url, output_path):
+    """Stream a PDF to disk, rejecting anything that isn't one; True on success"""
+    part_path = f"{output_path}.part"
+    try:
+        logger.info(f"Attempting to download PDF from: {url}")
+        async with session.get(url, headers=HEADERS) as response:
+            logger.info(f"PDF download response status: {response.status}")
+            if response.status != 200:
+                logger.error(f"PDF download failed: HTTP {response.status}")
+                return False
+            content_type = response.headers.get('Content-Type', '').lower()
+            if content_type.startswith(('text/html', 'application/json')):
+                # Login pages and API errors; don't bother reading them
+                logger.error(f"PDF download failed: got {content_type} from {url}")
+                return False
+
+            size = 0
+            head = b''
+            async with aiofiles.open(part_path, 'wb') as f:
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    if len(head) < PDF_HEADER_WINDOW:
+                        head += chunk[:PDF_HEADER_WINDOW - len(head)]
+                        if len(head) >= PDF_HEADER_WINDOW and PDF_MAGIC not in head:
+                            break
+                    await f.write(chunk)
+                    size += len(chunk)
+
+        if not head:
+            logger.error("PDF download failed: Empty content")
+        elif PDF_MAGIC not in head:
+            logger.error(f"PDF download failed: {url} is not a PDF ({content_type or 'no content type'})")
+        else:
+            os.replace(part_path, output_path)
+            logger.info(f"PDF downloaded successfully: {output_path} ({size} bytes)")
+            return True
+        return False
+    except Exception as e:
+        logger.error(f"PDF download error: {str(e)}")
+        return False
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+class PdfPrefetcher:
+    """Download the PDFs of upcoming batch entries in the background.
+
+    `schedule` starts the downloads for an entry right away, bounded by a
+    shared semaphore; the uploader later awaits each task and finds the
+    file already on disk.
+    """
+
+    def __init__(self, session, concurrency=PDF_PREFETCH_CONCURRENCY):
+        self.session = session
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.fetches = []
+
+    def schedule(self, pdfs, prefix):
+        """Start fetching `pdfs`; returns one (path, task) pair per PDF, in order"""
+        # Forget fetches that are finished and already cleaned up
+        self.fetches = [(path, task) for path, task in self.fetches if not task.done() or os.path.exists(path)]
+        fetches = []
+        for pdf_idx, pdf in enumerate(pdfs):
+            path = f"{prefix}_{pdf_idx}.pdf"
+            fetches.append((path, asyncio.create_task(self._fetch(pdf['url'], path))))
+        self.fetches.extend(fetches)
+        return fetches
+
+    async def _fetch(self, url, path):
+        async with self.semaphore:
+            return await download_pdf(self.session, url, path)
+
+    @staticmethod
+    def discard(fetches):
+        """Cancel unfinished fetches and remove whatever they left on disk"""
+        for path, task in fetches:
+            task.cancel()
+            if os.path.exists(path):
+                os.remove(path)
+
+    def close(self):
+        """Drop every fetch of the batch, including PDFs that never got uploaded"""
+        self.discard(self.fetches)
+        self.fetches = []
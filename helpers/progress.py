@@ -0,0 +1,63 @@
+import asyncio
+import logging
+import threading
+from contextlib import asynccontextmanager
+from helpers.ratelimit import limiter, MIN_EDIT_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+class ProgressSlot:
+    """Latest progress value of one job, written from any thread.
+
+    `update` only swaps a reference, so a download thread can call it on
+    every hook without paying for anything on the event loop.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = None
+        self.version = 0
+
+    def update(self, value):
+        with self.lock:
+            self.value = value
+            self.version += 1
+
+    def take(self, seen):
+        """Return (version, value) if something newer than `seen` arrived, else None"""
+        with self.lock:
+            if self.version == seen:
+                return None
+            return self.version, self.value
+
+@asynccontextmanager
+async def progress_ticker(message, render, interval=MIN_EDIT_INTERVAL, **edit_kwargs):
+    """Yield a ProgressSlot whose latest value is rendered into `message` every `interval` seconds.
+
+    `render(value)` returns the message text, or None to skip that value.
+    Edits come from this single task one after another, so they can't
+    overtake each other.
+    """
+    slot = ProgressSlot()
+
+    async def tick():
+        seen = 0
+        while True:
+            await asyncio.sleep(interval)
+            latest = slot.take(seen)
+            if latest is None:
+                continue
+            seen, value = latest
+            try:
+                text = render(value)
+            except Exception as e:
+                logger.error(f"Error rendering progress: {str(e)}")
+                continue
+            if text:
+                await limiter.edit(message, text, **edit_kwargs)
+
+    ticker = asyncio.create_task(tick())
+    try:
+        yield slot
+    finally:
+        ticker.cancel()
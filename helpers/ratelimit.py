@@ -0,0 +1,180 @@
+import time
+import asyncio
+import logging
+from pyrogram import Client
+from pyrogram.errors import FloodWait, MessageNotModified
+from pyrogram.session import Session
+
+# Constants
+GLOBAL_RATE = 25  # Requests per second across all chats (Telegram allows ~30)
+GLOBAL_BURST = 30
+CHAT_RATE = 1  # Requests per second to a single chat
+CHAT_BURST = 3
+MIN_EDIT_INTERVAL = 5  # Seconds between edits of the same message
+FLOOD_RETRIES = 3  # Times a request is retried after a FloodWait
+MAX_FLOOD_WAIT = 600  # Longer FloodWaits are raised to the caller instead
+IDLE_STATE_TTL = 600  # Seconds before per-chat/per-message state is dropped
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """Token bucket that hands out reservations instead of refusing requests"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def reserve(self):
+        """Take a token and return how long the caller has to wait for it"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # Tokens may go negative: later callers queue up behind earlier ones
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def block(self, seconds):
+        """Hold every request back for `seconds`, as a FloodWait demands"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    @property
+    def idle(self):
+        return self.tokens >= self.capacity and self.blocked_until < time.monotonic()
+
+def peer_key(query):
+    """Chat a raw API call is addressed to, None for calls without one"""
+    peer = getattr(query, 'peer', None)
+    for attr in ('user_id', 'chat_id', 'channel_id'):
+        value = getattr(peer, attr, None)
+        if value is not None:
+            return (attr, value)
+    return None
+
+class RateLimiter:
+    """One limiter for every outbound Telegram request.
+
+    Requests take a token from the global bucket and from the bucket of the
+    chat they address. A FloodWait blocks the bucket it was raised for, so
+    everything else bound for that chat waits too, and the request is
+    retried. Message edits are coalesced: while an edit waits for its turn,
+    newer text for the same message replaces it, and only the latest text
+    is sent.
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self.chat_buckets = {}
+        self.edits = {}  # (chat id, message id) -> edit waiting to be sent
+        self.last_edits = {}  # (chat id, message id) -> (time, text) of the last edit sent
+        self.tasks = set()
+        self.requests = 0
+        self.flood_waits = 0
+        self.coalesced = 0
+
+    def chat_bucket(self, peer):
+        if peer not in self.chat_buckets:
+            if len(self.chat_buckets) > 1000:
+                self.chat_buckets = {k: b for k, b in self.chat_buckets.items() if not b.idle}
+            self.chat_buckets[peer] = TokenBucket(CHAT_RATE, CHAT_BURST)
+        return self.chat_buckets[peer]
+
+    async def acquire(self, peer=None):
+        wait = self.global_bucket.reserve()
+        if peer is not None:
+            wait = max(wait, self.chat_bucket(peer).reserve())
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def invoke(self, send, query):
+        """Run `send()` for raw `query` once the buckets allow it, retrying FloodWaits"""
+        peer = peer_key(query)
+        for attempt in range(FLOOD_RETRIES + 1):
+            await self.acquire(peer)
+            self.requests += 1
+            try:
+                return await send()
+            except FloodWait as e:
+                if attempt == FLOOD_RETRIES or e.value > MAX_FLOOD_WAIT:
+                    raise
+                self.flood_waits += 1
+                bucket = self.chat_bucket(peer) if peer is not None else self.global_bucket
+                bucket.block(e.value)
+                logger.warning(
+                    f"FloodWait of {e.value}s on {type(query).__name__} "
+                    f"({'chat ' + str(peer[1]) if peer else 'global'}), retry {attempt + 1}/{FLOOD_RETRIES}"
+                )
+
+    def submit_edit(self, message, text, **kwargs):
+        """Queue an edit of `message` without waiting for it; returns a future"""
+        key = (message.chat.id, message.id)
+        pending = self.edits.get(key)
+        if pending:
+            pending['text'] = text
+            pending['kwargs'] = kwargs
+            self.coalesced += 1
+            return pending['done']
+
+        pending = {'text': text, 'kwargs': kwargs, 'done': asyncio.get_running_loop().create_future()}
+        self.edits[key] = pending
+        task = asyncio.create_task(self._send_edit(key, message, pending))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return pending['done']
+
+    async def edit(self, message, text, **kwargs):
+        """Edit `message` once it's its turn; True if the text was sent"""
+        return await asyncio.shield(self.submit_edit(message, text, **kwargs))
+
+    async def _send_edit(self, key, message, pending):
+        sent = False
+        try:
+            while True:
+                last = self.last_edits.get(key)
+                if last:
+                    wait = last[0] + MIN_EDIT_INTERVAL - time.monotonic()
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                text, kwargs = pending['text'], pending['kwargs']
+                if not last or last[1] != text:
+                    try:
+                        await message.edit_text(text, **kwargs)
+                        sent = True
+                    except MessageNotModified:
+                        pass
+                self.last_edits[key] = (time.monotonic(), text)
+                # Text that arrived while we were sending goes out next, in order
+                if pending['text'] is text and pending['kwargs'] is kwargs:
+                    break
+        except Exception as e:
+            logger.error(f"Message edit error: {str(e)}")
+        finally:
+            if self.edits.get(key) is pending:
+                self.edits.pop(key)
+            if not pending['done'].done():
+                pending['done'].set_result(sent)
+            if len(self.last_edits) > 1000:
+                cutoff = time.monotonic() - IDLE_STATE_TTL
+                self.last_edits = {k: v for k, v in self.last_edits.items() if v[0] > cutoff}
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'flood_waits': self.flood_waits,
+            'coalesced': self.coalesced,
+            'pending_edits': len(self.edits),
+            'chats': len(self.chat_buckets),
+        }
+
+limiter = RateLimiter()
+
+class RateLimitedClient(Client):
+    """Client whose API calls all go through the shared limiter"""
+
+    async def invoke(self, query, retries=Session.MAX_RETRIES, timeout=Session.WAIT_TIMEOUT, sleep_threshold=None):
+        # FloodWaits always surface (threshold 0) so the limiter can hold back the whole chat
+        send = super().invoke
+        return await limiter.invoke(lambda: send(query, retries, timeout, sleep_threshold=0), query)
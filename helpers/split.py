@@ -0,0 +1,104 @@
+import os
+import math
+import asyncio
+import logging
+from helpers.ffmpeg import job_cost, probe_media, run_ffmpeg, scheduler
+from helpers.jobs import track_temp
+
+# Constants
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_MB", 2000)) * 1024 ** 2  # Telegram's limit for bot uploads
+PART_TARGET = 0.9  # Fraction of the limit each part aims for; bitrate varies along a file
+MIN_PART_SECONDS = 10  # Parts are never cut shorter than this
+
+logger = logging.getLogger(__name__)
+
+def estimate_size(bandwidth=None, duration=None, filesize=None):
+    """Expected output bytes from a known size, or stream bandwidth (bits/s) x duration"""
+    if filesize:
+        return int(filesize)
+    if bandwidth and duration:
+        return int(bandwidth / 8 * duration)
+    return None
+
+def parts_needed(size, max_bytes=MAX_UPLOAD_BYTES):
+    """How many uploads a file of `size` bytes will take"""
+    if not size or size <= max_bytes:
+        return 1
+    return math.ceil(size / (max_bytes * PART_TARGET))
+
+def part_path(path, index):
+    stem, ext = os.path.splitext(path)
+    return f"{stem}.part{index:02d}{ext}"
+
+async def cut_part(input_file, output_file, start, length):
+    """Copy `length` seconds from `start` into a file that plays on its own"""
+    cmd = [
+        'ffmpeg', '-y', '-hide_banner', '-loglevel', 'error',
+        # Input seeking with stream copy starts the part on a keyframe
+        '-ss', f"{start:.3f}", '-i', input_file, '-t', f"{length:.3f}",
+        '-map', '0', '-c', 'copy', '-avoid_negative_ts', 'make_zero'
+    ]
+    if output_file.endswith('.mp4'):
+        cmd += ['-movflags', '+faststart']
+    cmd.append(output_file)
+    async with scheduler.slot(job_cost(length, True)):
+        returncode, stderr = await run_ffmpeg(cmd)
+    if returncode != 0 or not os.path.exists(output_file):
+        raise Exception(f"Splitting failed: {stderr}")
+
+async def split_media(input_file, max_bytes=MAX_UPLOAD_BYTES):
+    """Yield consecutive time-based parts of `input_file`, each under `max_bytes`.
+
+    Parts are cut one at a time as the caller asks for them, so the first
+    can be uploaded while the rest don't exist yet.
+    """
+    size = os.path.getsize(input_file)
+    duration = (await probe_media(input_file))['duration']
+    if not duration:
+        raise Exception("Can't split a file of unknown duration")
+
+    average_length = duration * max_bytes * PART_TARGET / size
+    start = 0.0
+    index = 1
+    while start < duration - 1:
+        output_file = part_path(input_file, index)
+        track_temp(output_file)
+        length = average_length
+        while True:
+            await cut_part(input_file, output_file, start, length)
+            part_size = os.path.getsize(output_file)
+            if part_size <= max_bytes or length <= MIN_PART_SECONDS:
+                break
+            # A busier stretch than average: cut it shorter
+            length = max(MIN_PART_SECONDS, length * max_bytes * PART_TARGET / part_size)
+        logger.info(f"Cut part {index} of {input_file}: {start:.0f}s +{length:.0f}s, {part_size} bytes")
+        yield output_file
+        start += length
+        index += 1
+
+async def send_in_parts(input_file, send, max_bytes=MAX_UPLOAD_BYTES):
+    """Split `input_file` and `await send(part_file, index)` for each part.
+
+    The next part is cut while the current one uploads; every part is
+    deleted once sent. Returns the number of parts.
+    """
+    parts = split_media(input_file, max_bytes)
+    next_part = asyncio.ensure_future(anext(parts))
+    index = 0
+    try:
+        while True:
+            try:
+                part_file = await next_part
+            except StopAsyncIteration:
+                return index
+            index += 1
+            next_part = asyncio.ensure_future(anext(parts))
+            try:
+                await send(part_file, index)
+            finally:
+                if os.path.exists(part_file):
+                    os.remove(part_file)
+    finally:
+        next_part.cancel()
+        await asyncio.gather(next_part, return_exceptions=True)
+        await parts.aclose()
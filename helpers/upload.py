@@ -0,0 +1,192 @@
+import io
+import os
+import math
+import time
+import asyncio
+import inspect
+import logging
+from pathlib import PurePath
+from pyrogram import raw
+from pyrogram.errors import FloodWait
+from pyrogram.session import Session
+from helpers.ratelimit import RateLimitedClient
+
+# Constants
+UPLOAD_PART_SIZE = 512 * 1024  # Not configurable: 4000 parts max per file, and pyrogram's resends assume 512 KB
+UPLOAD_SESSIONS = int(os.environ.get("UPLOAD_SESSIONS", 4))  # Media connections per upload
+UPLOAD_PARALLEL_PARTS = int(os.environ.get("UPLOAD_PARALLEL_PARTS", 8))  # Parts in flight per upload
+PART_RETRIES = 5  # Attempts per part before the upload fails
+PART_RETRY_DELAY = 1  # Seconds before the first retry, doubled after each one
+BIG_FILE_SIZE = 10 * 1024 * 1024  # Smaller files use pyrogram's own single-connection upload
+
+logger = logging.getLogger(__name__)
+
+class UploadStats:
+    """Counters for /stats"""
+
+    def __init__(self):
+        self.files = 0
+        self.parts = 0
+        self.retries = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def summary(self):
+        speed = self.bytes / self.seconds if self.seconds else 0
+        return {
+            'files': self.files,
+            'parts': self.parts,
+            'retries': self.retries,
+            'speed': speed,
+        }
+
+upload_stats = UploadStats()
+
+class ParallelUploader:
+    """Upload one big file with SaveBigFilePart over several media sessions.
+
+    Parts are read in order into a bounded queue and sent by
+    UPLOAD_PARALLEL_PARTS workers spread over UPLOAD_SESSIONS connections.
+    A part that fails is retried on its own, so a network hiccup or
+    FloodWait costs one part instead of the whole file.
+    """
+
+    def __init__(self, client, fp, file_size, progress=None, progress_args=()):
+        self.client = client
+        self.fp = fp
+        self.file_size = file_size
+        self.total_parts = math.ceil(file_size / UPLOAD_PART_SIZE)
+        self.file_id = client.rnd_id()
+        self.progress = progress
+        self.progress_args = progress_args
+        self.uploaded = 0
+        self.paused_until = 0.0  # A FloodWait holds back every worker
+
+    async def _open_sessions(self):
+        dc_id = await self.client.storage.dc_id()
+        auth_key = await self.client.storage.auth_key()
+        test_mode = await self.client.storage.test_mode()
+        sessions = [
+            Session(self.client, dc_id, auth_key, test_mode, is_media=True)
+            for _ in range(max(1, UPLOAD_SESSIONS))
+        ]
+        await asyncio.gather(*(session.start() for session in sessions))
+        return sessions
+
+    async def _send_part(self, session, part, chunk):
+        rpc = raw.functions.upload.SaveBigFilePart(
+            file_id=self.file_id,
+            file_part=part,
+            file_total_parts=self.total_parts,
+            bytes=chunk
+        )
+        delay = PART_RETRY_DELAY
+        for attempt in range(PART_RETRIES):
+            wait = self.paused_until - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                if await session.invoke(rpc, sleep_threshold=0):
+                    return
+                raise Exception("Telegram did not accept the part")
+            except FloodWait as e:
+                self.paused_until = max(self.paused_until, time.monotonic() + e.value)
+            except Exception as e:
+                if attempt == PART_RETRIES - 1:
+                    raise Exception(f"Part {part} failed after {PART_RETRIES} attempts: {str(e)}")
+                logger.warning(f"Part {part} failed, retrying in {delay}s: {str(e)}")
+                await asyncio.sleep(delay)
+                delay *= 2
+            upload_stats.retries += 1
+        raise Exception(f"Part {part} failed after {PART_RETRIES} attempts")
+
+    async def _report(self):
+        if not self.progress:
+            return
+        if inspect.iscoroutinefunction(self.progress):
+            await self.progress(self.uploaded, self.file_size, *self.progress_args)
+        else:
+            await self.client.loop.run_in_executor(
+                self.client.executor, self.progress, self.uploaded, self.file_size, *self.progress_args
+            )
+
+    async def _worker(self, session, queue):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            part, chunk = item
+            await self._send_part(session, part, chunk)
+            self.uploaded = min(self.uploaded + len(chunk), self.file_size)
+            upload_stats.parts += 1
+            await self._report()
+
+    async def upload(self):
+        start = time.monotonic()
+        sessions = await self._open_sessions()
+        queue = asyncio.Queue(UPLOAD_PARALLEL_PARTS)
+        workers = [
+            asyncio.create_task(self._worker(sessions[i % len(sessions)], queue))
+            for i in range(max(1, UPLOAD_PARALLEL_PARTS))
+        ]
+
+        async def feed():
+            for part in range(self.total_parts):
+                chunk = self.fp.read(UPLOAD_PART_SIZE)
+                await queue.put((part, chunk))
+            for _ in workers:
+                await queue.put(None)
+
+        feeder = asyncio.create_task(feed())
+        try:
+            # The first failing worker (or a StopTransmission from progress) ends the upload
+            done, _ = await asyncio.wait(workers + [feeder], return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+        finally:
+            for task in workers + [feeder]:
+                task.cancel()
+            await asyncio.gather(*workers, feeder, return_exceptions=True)
+            await asyncio.gather(*(session.stop() for session in sessions), return_exceptions=True)
+
+        elapsed = time.monotonic() - start
+        upload_stats.files += 1
+        upload_stats.bytes += self.file_size
+        upload_stats.seconds += elapsed
+        logger.info(
+            f"Uploaded {self.file_size / 1024 ** 2:.1f} MB in {self.total_parts} parts "
+            f"over {len(sessions)} sessions in {elapsed:.1f}s"
+        )
+        return raw.types.InputFileBig(
+            id=self.file_id,
+            parts=self.total_parts,
+            name=getattr(self.fp, "name", "file")
+        )
+
+class ParallelUploadClient(RateLimitedClient):
+    """Client whose big uploads go out over several connections at once"""
+
+    async def save_file(self, path, file_id=None, file_part=0, progress=None, progress_args=()):
+        # Pyrogram's missing-part resends and anything that isn't a file keep the stock path
+        if file_id is not None or not isinstance(path, (str, PurePath, io.IOBase)):
+            return await super().save_file(path, file_id, file_part, progress, progress_args)
+
+        if isinstance(path, io.IOBase):
+            path.seek(0, os.SEEK_END)
+            file_size = path.tell()
+            path.seek(0)
+        else:
+            file_size = os.path.getsize(path)
+        # Thumbnails and small files need SaveFilePart with an md5, which pyrogram handles
+        if file_size <= BIG_FILE_SIZE:
+            return await super().save_file(path, file_id, file_part, progress, progress_args)
+
+        size_limit = (4000 if self.me.is_premium else 2000) * 1024 * 1024
+        if file_size > size_limit:
+            raise ValueError(f"Can't upload files bigger than {size_limit // (1024 * 1024)} MiB")
+
+        async with self.save_file_semaphore:
+            if isinstance(path, io.IOBase):
+                return await ParallelUploader(self, path, file_size, progress, progress_args).upload()
+            with open(path, "rb") as fp:
+                return await ParallelUploader(self, fp, file_size, progress, progress_args).upload()
@@ -0,0 +1,221 @@
+import os
+import glob
+import time
+import shutil
+import asyncio
+import logging
+import contextvars
+from contextlib import asynccontextmanager
+
+# Constants
+WORK_ROOT = os.environ.get("WORK_DIR", "/tmp/megabot")
+MIN_FREE_BYTES = int(float(os.environ.get("MIN_FREE_GB", 1)) * 1024 ** 3)  # Always left free on the disk
+RESERVE_TIMEOUT = 30 * 60  # Seconds a job waits for space before giving up
+RESERVE_POLL = 5  # Seconds between free-space checks while waiting
+PARTIAL_TTL = 24 * 3600  # Seconds a resumable download is kept after its last write
+# Leftovers of versions that wrote into the working directory
+LEGACY_PATTERNS = ('temp_*.ts', 'temp_*.mp4', 'temp_*.mp3', 'temp_pdf_*', 'video_*.ts', 'video_*.mp4',
+                   'video_*.mp3', 'converted_*.mp4', 'converted_*.mp3', '*.manifest.json')
+
+logger = logging.getLogger(__name__)
+
+# Workspace of the job running the current code
+current_workspace = contextvars.ContextVar('current_workspace', default=None)
+
+class DiskSpaceError(Exception):
+    """A job needs more disk space than the bot can give it"""
+
+def dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+class Workspace:
+    """Private directory of one job plus the disk space reserved for it.
+
+    Space is reserved per output, keyed by the file it is for (None for
+    outputs whose name isn't known up front), and given back with
+    release() once that output has been uploaded and deleted.
+    """
+
+    def __init__(self, manager, name):
+        self.manager = manager
+        self.dir = os.path.join(manager.root, name)
+        self.reservations = {}
+        os.makedirs(self.dir, exist_ok=True)
+
+    @property
+    def reserved(self):
+        return sum(self.reservations.values())
+
+    def path(self, name=''):
+        return os.path.join(self.dir, name)
+
+    def outstanding(self):
+        """Reserved bytes the job hasn't written yet"""
+        total = 0
+        for key, size in self.reservations.items():
+            if key is None:
+                written = dir_size(self.dir)
+            else:
+                written = os.path.getsize(key) if os.path.exists(key) else 0
+            total += max(0, size - written)
+        return total
+
+    async def reserve(self, size, key=None):
+        """Set aside `size` bytes for `key`, waiting while other jobs free up space"""
+        await self.manager.reserve(self, size, key)
+
+    def release(self, key=None):
+        """Give back the space reserved for `key`"""
+        if self.reservations.pop(key, None) is not None:
+            self.manager.changed.set()
+
+    def move(self, old_key, new_key):
+        """Carry a reservation over to the file that replaces `old_key` (e.g. after converting)"""
+        if old_key in self.reservations:
+            self.reservations[new_key] = self.reservations.pop(old_key)
+
+class WorkspaceManager:
+    """Hands out per-job directories and keeps the disk from filling up.
+
+    A job reserves its expected output size before downloading. While
+    reservations of running jobs would leave less than MIN_FREE_BYTES free,
+    the job waits; if it couldn't fit even on an otherwise idle disk, it is
+    refused right away.
+    """
+
+    def __init__(self, root=WORK_ROOT, min_free=MIN_FREE_BYTES):
+        self.root = root
+        self.min_free = min_free
+        self.partial_dir = os.path.join(root, 'partial')
+        self.active = set()
+        self.changed = asyncio.Event()
+
+    def available(self, exclude=None):
+        """Free bytes not yet promised to a running job"""
+        os.makedirs(self.root, exist_ok=True)
+        free = shutil.disk_usage(self.root).free
+        promised = sum(ws.outstanding() for ws in self.active if ws is not exclude)
+        return free - promised - self.min_free
+
+    async def reserve(self, workspace, size, key=None):
+        # Reserving for the same output again (a retry, a resend) replaces the old amount
+        workspace.release(key)
+        if not size:
+            return
+        if size > shutil.disk_usage(self.root).free - self.min_free:
+            raise DiskSpaceError(
+                f"Not enough disk space: this job needs ~{size / 1024 ** 3:.1f} GB"
+            )
+        deadline = time.time() + RESERVE_TIMEOUT
+        while self.available(exclude=workspace) - workspace.outstanding() < size:
+            if time.time() > deadline:
+                raise DiskSpaceError("Timed out waiting for disk space")
+            if workspace not in self.active:
+                # The job ended (e.g. was cancelled) while a worker thread waited here
+                raise DiskSpaceError("Job finished while waiting for disk space")
+            logger.info(f"Waiting for {size / 1024 ** 2:.0f} MB of disk space for {workspace.dir}")
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(self.changed.wait(), RESERVE_POLL)
+            except asyncio.TimeoutError:
+                pass
+        workspace.reservations[key] = size
+
+    @asynccontextmanager
+    async def open(self, name):
+        """Create a job directory for the duration of the block, removing it afterwards"""
+        workspace = Workspace(self, name)
+        self.active.add(workspace)
+        token = current_workspace.set(workspace)
+        try:
+            yield workspace
+        finally:
+            current_workspace.reset(token)
+            self.active.discard(workspace)
+            shutil.rmtree(workspace.dir, ignore_errors=True)
+            self.changed.set()
+
+    def partial_path(self, name):
+        """Location for resumable downloads, shared across jobs and restarts"""
+        os.makedirs(self.partial_dir, exist_ok=True)
+        return os.path.join(self.partial_dir, name)
+
+    def sweep(self):
+        """Remove what a previous run left behind; resumable downloads are kept"""
+        os.makedirs(self.root, exist_ok=True)
+        removed = 0
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if path == self.partial_dir:
+                continue
+            # No job survives a restart, so every job directory is an orphan
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+            removed += 1
+
+        if os.path.isdir(self.partial_dir):
+            cutoff = time.time() - PARTIAL_TTL
+            for name in os.listdir(self.partial_dir):
+                path = os.path.join(self.partial_dir, name)
+                if name.endswith('.manifest.json'):
+                    data_file = path[:-len('.manifest.json')]
+                    keep = os.path.exists(data_file) and os.path.getmtime(data_file) > cutoff
+                elif name.endswith('.tmp'):
+                    keep = False
+                else:
+                    keep = os.path.exists(f"{path}.manifest.json") and os.path.getmtime(path) > cutoff
+                if not keep:
+                    os.remove(path)
+                    removed += 1
+
+        for pattern in LEGACY_PATTERNS:
+            for path in glob.glob(pattern):
+                os.remove(path)
+                removed += 1
+        logger.info(f"Workspace sweep removed {removed} orphaned files in {self.root}")
+
+    def stats(self):
+        usage = shutil.disk_usage(self.root) if os.path.isdir(self.root) else None
+        return {
+            'jobs': len(self.active),
+            'reserved': sum(ws.reserved for ws in self.active),
+            'free': usage.free if usage else 0,
+        }
+
+workspaces = WorkspaceManager()
+
+def work_path(name=''):
+    """Path inside the current job's directory (a shared scratch directory outside jobs)"""
+    workspace = current_workspace.get()
+    if workspace:
+        return workspace.path(name)
+    scratch = os.path.join(workspaces.root, 'scratch')
+    os.makedirs(scratch, exist_ok=True)
+    return os.path.join(scratch, name)
+
+async def reserve_space(size, key=None):
+    """Reserve `size` bytes for the current job's output `key`; a no-op outside jobs"""
+    workspace = current_workspace.get()
+    if workspace:
+        await workspace.reserve(size, key)
+
+def release_space(key=None):
+    """Give back the current job's reservation for `key` once its file is gone"""
+    workspace = current_workspace.get()
+    if workspace:
+        workspace.release(key)
+
+def move_space(old_key, new_key):
+    """Let the reservation for `old_key` cover the file that replaces it"""
+    workspace = current_workspace.get()
+    if workspace:
+        workspace.move(old_key, new_key)
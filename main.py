@@ -1,9 +1,18 @@
 import os
 import sys
+import time
 import logging
 from datetime import datetime
-from pyrogram import Client, idle, filters
+from pyrogram import idle, filters
 from pyrogram.types import Message, BotCommand
+from helpers.ffmpeg import scheduler
+from helpers.cache import cache
+from helpers.fileids import file_ids
+from helpers.ratelimit import limiter
+from helpers.upload import ParallelUploadClient, upload_stats
+from helpers.jobs import jobs, format_eta
+from helpers.workspace import workspaces
+from helpers.httpclient import http_client
 
 # Constants
 ADMIN_USERNAME = "harshMrDev"
@@ -17,7 +26,7 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Initialize bot
-app = Client(
+app = ParallelUploadClient(
     "youtube_downloader_bot",
     api_id=os.environ.get("API_ID"),
     api_hash=os.environ.get("API_HASH"),
@@ -31,7 +40,8 @@ COMMANDS = [
     BotCommand("help", "Show help message"),
     BotCommand("ping", "Check bot response"),
     BotCommand("utube", "Download from YouTube"),
-    BotCommand("m3u8", "Download M3U8 streams")
+    BotCommand("m3u8", "Download M3U8 streams"),
+    BotCommand("queue", "Show your place in the queue")
 ]
 
 @app.on_message(filters.command(["start", "help"]) & filters.private)
@@ -45,12 +55,106 @@ async def start_command(client, message):
         "/help - Show help message\n"
         "/ping - Check bot response\n"
         "/utube - Download from YouTube\n"
-        "/m3u8 - Download M3U8 streams\n\n"  # Added M3U8 command to welcome message
+        "/m3u8 - Download M3U8 streams\n"  # Added M3U8 command to welcome message
+        "/queue - Show your place in the queue\n\n"
         f"🕒 Bot Started: {START_TIME}\n"
         f"👨‍💻 Admin: @{ADMIN_USERNAME}"
     )
 
+@app.on_message(filters.command("queue") & filters.private)
+async def queue_command(client, message):
+    """Show the caller's running and waiting jobs; the admin sees everyone's"""
+    stats = jobs.stats()
+    lines = [
+        "🚦 Job queue\n",
+        f"▶️ Running: {stats['running']}/{stats['max_active']}",
+        f"⏳ Waiting: {stats['queued']}/{stats['max_queued']}",
+    ]
+    if message.from_user.username == ADMIN_USERNAME:
+        user_ids = {job.user_id for job in jobs.running} | set(jobs.waiting)
+    else:
+        user_ids = {message.from_user.id}
+
+    for user_id in sorted(user_ids):
+        user_jobs = jobs.jobs_for(user_id)
+        if not user_jobs:
+            continue
+        lines.append("")
+        if len(user_ids) > 1:
+            lines.append(f"👤 {user_id}")
+        for job, position in user_jobs:
+            if position:
+                lines.append(f"• #{position} {job.label} ({format_eta(jobs.eta(position))})")
+            else:
+                lines.append(f"• ▶️ {job.label} (running {int(time.time() - job.started)}s)")
+    if len(lines) == 3:
+        lines.append("\nYou have no jobs queued.")
+    await message.reply_text("\n".join(lines))
+
+@app.on_callback_query(filters.regex(r'^cancel_job:\d+$'))
+async def cancel_job_callback(client, callback_query):
+    """Stop a queued or running job from the Cancel button on its messages"""
+    job = jobs.get(int(callback_query.data.split(':')[1]))
+    if not job:
+        await callback_query.answer("This job has already finished.")
+        return
+    if job.user_id != callback_query.from_user.id and callback_query.from_user.username != ADMIN_USERNAME:
+        await callback_query.answer("Only the owner can cancel this job.", show_alert=True)
+        return
+    jobs.cancel(job)
+    logger.info(f"User {callback_query.from_user.id} cancelled job {job.id} ({job.label})")
+    await callback_query.answer("Cancelling...")
+    await limiter.edit(callback_query.message, f"❌ Cancelled: {job.label}")
+
+@app.on_message(filters.command("stats") & filters.private)
+async def stats_command(client, message):
+    """Admin-only resource stats for sizing the container"""
+    if message.from_user.username != ADMIN_USERNAME:
+        return
+    ffmpeg_stats = scheduler.stats()
+    cache_stats = cache.stats()
+    limiter_stats = limiter.stats()
+    upload_summary = upload_stats.summary()
+    job_stats = jobs.stats()
+    disk_stats = workspaces.stats()
+    http_stats = http_client.stats()
+    await message.reply_text(
+        "📊 Bot stats\n\n"
+        f"🎞 ffmpeg: {ffmpeg_stats['active']}/{ffmpeg_stats['slots']} slots busy, "
+        f"{ffmpeg_stats['threads_per_slot']} threads each, {ffmpeg_stats['piped']} piped\n"
+        f"⏳ Queued conversions: {ffmpeg_stats['queued']}\n"
+        f"⌛ Slot wait: avg {ffmpeg_stats['avg_wait']:.1f}s / max {ffmpeg_stats['max_wait']:.1f}s\n"
+        f"✅ Conversions finished: {ffmpeg_stats['completed']}\n"
+        f"🗄 Download cache: {cache_stats['entries']} files, "
+        f"{cache_stats['size'] / 1024 ** 3:.2f}/{cache_stats['max_bytes'] / 1024 ** 3:.0f} GB, "
+        f"{cache_stats['hits']} hits / {cache_stats['misses']} misses\n"
+        f"📨 Known file_ids: {file_ids.count()}, {file_ids.hits} resent\n"
+        f"🚦 API calls: {limiter_stats['requests']}, {limiter_stats['flood_waits']} FloodWaits, "
+        f"{limiter_stats['coalesced']} edits coalesced\n"
+        f"📤 Uploads: {upload_summary['files']} files, {upload_summary['parts']} parts, "
+        f"{upload_summary['retries']} part retries, avg {upload_summary['speed'] / 1024 ** 2:.1f} MB/s\n"
+        f"🚦 Jobs: {job_stats['running']} running, {job_stats['queued']} waiting, "
+        f"{job_stats['rejected']} refused\n"
+        f"💽 Workspace: {disk_stats['jobs']} job dirs, "
+        f"{disk_stats['reserved'] / 1024 ** 3:.2f} GB reserved, {disk_stats['free'] / 1024 ** 3:.1f} GB free\n"
+        f"🌐 HTTP: {http_stats['requests']} requests, {http_stats['created']} connections opened / "
+        f"{http_stats['reused']} reused, {http_stats['in_use']} busy + {http_stats['idle']} idle "
+        f"of {http_stats['limit']}, DNS cache {http_stats['dns_hits']} hits / {http_stats['dns_misses']} misses"
+    )
+
+async def main():
+    """Run the bot with the shared HTTP pool open for its whole lifetime"""
+    await http_client.start()
+    try:
+        await app.start()
+        await idle()
+        await app.stop()
+    finally:
+        await http_client.close()
+
 print(f"Bot Starting... Time: {START_TIME}")
 
 if __name__ == "__main__":
-    app.run()
+    # Nothing from a previous run is still in use, apart from resumable downloads
+    workspaces.sweep()
+    app.run(main())
@@ -1,24 +1,45 @@
 import os
 import re
 import m3u8
+import hashlib
 import time
-import aiohttp
-import aiofiles
 import asyncio
 import logging
 import subprocess
+from contextlib import aclosing
 from datetime import datetime
 from urllib.parse import urljoin, unquote
 from pyrogram import Client, filters
 from pyrogram.types import Message
+from helpers.hls import (
+    HEADERS, LIVE_MAX_SECONDS, MAX_CONCURRENT_DOWNLOADS, SEGMENT_FAILURE_BUDGET, FetchStats, KeyCache, LivePlaylist,
+    SegmentSink, fetch_segments_ordered, load_manifest, manifest_path, remove_manifest, resume_point, segment_key,
+    select_variant, variant_label
+)
+from helpers.batchfile import iter_entries, iter_media_lines
+from helpers.pdf import PdfPrefetcher
+from helpers.httpclient import http_client
+from helpers.cache import cache, cache_key
+from helpers.fileids import file_ids
+from helpers.ratelimit import limiter
+from helpers.jobs import cancel_button, enqueue, track_temp
+from helpers.workspace import move_space, release_space, reserve_space, work_path, workspaces
+from helpers.split import MAX_UPLOAD_BYTES, estimate_size, parts_needed, send_in_parts
+from helpers.ffmpeg import FfmpegPipeSink, build_convert_cmd, can_remux, job_cost, probe_media, run_ffmpeg, scheduler
 
 # Constants
 START_TIME = "2025-06-18 19:11:14"
 ADMIN_USERNAME = "harshMrDev"
-MAX_CONCURRENT_DOWNLOADS = 5
-MIN_DELAY_BETWEEN_UPDATES = 5  # Minimum seconds between status updates
 MIN_DELAY_BETWEEN_ENTRIES = 10  # Minimum seconds between processing entries
-CHUNK_SIZE = 1024 * 1024  # 1 MB
+ENTRY_QUEUE_SIZE = 20  # Parsed batch entries buffered ahead of the downloader
+PIPELINE_QUEUE_SIZE = 1  # Finished entries waiting between pipeline stages
+# Opt-in: pipe segments straight into ffmpeg instead of staging a .ts. Saves disk and
+# a conversion pass, but only staged downloads can resume after a restart
+STREAM_CONVERSION = os.environ.get("M3U8_STREAM_CONVERSION", "0") == "1"
+
+# Output files recorded from live playlists: their content differs on every run,
+# so they are neither cached nor remembered by file_id
+live_recordings = set()
 
 # Configure logging
 logging.basicConfig(
@@ -27,40 +48,9 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Headers for requests
-HEADERS = {
-    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-    'Accept': '*/*',
-}
-
-# Track last update times
-last_progress_update = {}
-last_status_update = {}
-last_message_update = {}
-
-async def safe_edit_message(message, text, sleep_on_flood=True):
-    """Safely edit message with flood control"""
-    try:
-        now = time.time()
-        message_id = f"{message.chat.id}:{message.id}"
-
-        if message_id in last_message_update:
-            time_since_last = now - last_message_update[message_id]
-            if time_since_last < MIN_DELAY_BETWEEN_UPDATES:
-                await asyncio.sleep(MIN_DELAY_BETWEEN_UPDATES - time_since_last)
-
-        await message.edit_text(text)
-        last_message_update[message_id] = now
-
-    except Exception as e:
-        if "FLOOD_WAIT" in str(e):
-            if sleep_on_flood:
-                wait_time = int(str(e).split('wait of ')[1].split(' seconds')[0])
-                logger.info(f"FloodWait: {wait_time} seconds")
-                await asyncio.sleep(wait_time + 5)
-                return await safe_edit_message(message, text, False)
-        else:
-            logger.error(f"Message edit error: {str(e)}")
+async def safe_edit_message(message, text, cancellable=True):
+    """Edit a status message through the shared rate limiter, keeping the job's Cancel button"""
+    await limiter.edit(message, text, reply_markup=cancel_button() if cancellable else None)
 
 def clean_filename(title):
     """Clean filename from invalid characters while preserving category"""
@@ -96,6 +86,46 @@ def clean_filename(title):
 
     return title.strip('. ')
 
+def command_args(message):
+    """Arguments of a `/m3u8 720 30m` style command the message replies to"""
+    reply = message.reply_to_message
+    if not reply or not reply.text or not re.match(r'/(?:m3u8|mp4|mp3)\b', reply.text):
+        return []
+    return reply.text.split()[1:]
+
+def requested_height(message):
+    """Resolution asked for as e.g. `720` or `720p`"""
+    for arg in command_args(message):
+        match = re.fullmatch(r'(\d{3,4})p?', arg.lower())
+        if match:
+            return int(match.group(1))
+    return None
+
+def requested_live_cap(message):
+    """Longest recording of a live stream asked for as e.g. `30m` or `2h`, in seconds"""
+    for arg in command_args(message):
+        match = re.fullmatch(r'(\d+)(m|min|h)', arg.lower())
+        if match:
+            return int(match.group(1)) * (3600 if match.group(2) == 'h' else 60)
+    return None
+
+def forget_output(path):
+    """Drop what the job tracked for an output that is finished with, uploaded or not"""
+    release_space(path)
+    live_recordings.discard(path)
+
+def reusable(path):
+    """Whether a finished file may be cached and resent by file_id"""
+    return path not in live_recordings
+
+def job_key(url):
+    """Stable short key for a URL so a restarted job finds its partial download"""
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
+
+def entry_name(user_id, index, url):
+    """File name stem for a batch entry; the index keeps duplicate URLs in one batch apart"""
+    return f"temp_{user_id}_{index}_{job_key(url)}"
+
 def create_progress_bar(current, total, bar_length=20):
     """Create a progress bar string"""
     if total == 0:
@@ -125,682 +155,716 @@ def time_formatter(seconds):
     hours, minutes = divmod(minutes, 60)
     return f"{hours:02d}h:{minutes:02d}m:{seconds:02d}s"
 
-async def handle_flood_wait(e, message, retry_action=None):
-    """Enhanced FloodWait handler with retry support"""
-    try:
-        if "FLOOD_WAIT" in str(e):
-            wait_time = int(str(e).split('wait of ')[1].split(' seconds')[0])
-            logger.info(f"FloodWait detected: waiting for {wait_time} seconds")
-
-            try:
-                await safe_edit_message(
-                    message,
-                    f"⏳ Rate limit reached\n"
-                    f"Waiting for {time_formatter(wait_time)}...\n"
-                    f"Bot will automatically resume after the wait time."
-                )
-            except Exception:
-                pass
-
-            await asyncio.sleep(wait_time + 5)
+def format_speed(speed):
+    """Transfer speed for upload/download progress"""
+    return f"{humanbytes(speed)}/s"
 
-            if retry_action:
-                try:
-                    await retry_action()
-                    return True
-                except Exception as retry_error:
-                    logger.error(f"Retry action failed: {str(retry_error)}")
-                    return False
-
-            return True
-        return False
-    except Exception as e:
-        logger.error(f"Error handling flood wait: {str(e)}")
-        return False
+def format_realtime(speed):
+    """Conversion speed as a multiple of playback speed"""
+    return f"{speed:.1f}x realtime"
 
-async def progress(current, total, message, start, text):
-    """Update progress bar with rate limiting"""
+async def progress(current, total, message, start, text, speed_formatter=format_speed):
+    """Queue a progress update; the limiter coalesces them so callers never wait"""
     try:
-        now = time.time()
-        message_id = f"{message.chat.id}:{message.id}"
-
-        if message_id not in last_progress_update:
-            last_progress_update[message_id] = 0
-
-        if now - last_progress_update[message_id] < MIN_DELAY_BETWEEN_UPDATES:
-            return
-
         if total is None:
             total = current
 
         if current <= 0 or total <= 0:
             return
 
-        diff = now - start
+        diff = time.time() - start
         speed = current / diff if diff > 0 else 0
         eta = (total - current) / speed if speed > 0 else 0
 
         progress_bar = create_progress_bar(current, total)
 
-        try:
-            await safe_edit_message(
-                message,
-                f"{text}\n"
-                f"{progress_bar}\n"
-                f"📊 Progress: {current * 100 / total:.1f}%\n"
-                f"🚀 Speed: {humanbytes(speed)}/s\n"
-                f"⏱ ETA: {time_formatter(eta)}"
-            )
-            last_progress_update[message_id] = now
-        except Exception as e:
-            if "FLOOD_WAIT" in str(e):
-                async def retry():
-                    await safe_edit_message(
-                        message,
-                        f"{text}\n{progress_bar}\n"
-                        f"📊 Progress: {current * 100 / total:.1f}%"
-                    )
-                await handle_flood_wait(e, message, retry)
+        limiter.submit_edit(
+            message,
+            f"{text}\n"
+            f"{progress_bar}\n"
+            f"📊 Progress: {current * 100 / total:.1f}%\n"
+            f"🚀 Speed: {speed_formatter(speed)}\n"
+            f"⏱ ETA: {time_formatter(eta)}",
+            reply_markup=cancel_button()
+        )
     except Exception as e:
         logger.error(f"Progress update error: {str(e)}")
 
-async def download_segment(session, url, output_file):
-    """Download a single segment"""
+async def process_m3u8(url, output_file, status_msg, concurrency=MAX_CONCURRENT_DOWNLOADS,
+                       failure_budget=SEGMENT_FAILURE_BUDGET, output_format=None, audio_only=False, height=None,
+                       live_cap=None):
+    """Process M3U8 playlist with rate-limited updates.
+
+    With `output_format`, segments are piped into ffmpeg and `output_file` is
+    the converted result; otherwise they are staged into a resumable .ts.
+    `audio_only` and `height` choose the rendition of a master playlist.
+    Live and EVENT playlists are followed until they end or `live_cap`
+    seconds have been recorded.
+    """
+    # Partial output is only worth keeping for a resume, not after a cancel
+    track_temp(output_file, manifest_path(output_file))
+    stats = FetchStats()
     try:
-        async with session.get(url, headers=HEADERS) as response:
-            if response.status == 200:
-                async with aiofiles.open(output_file, 'ab') as f:
-                    await f.write(await response.read())
-                return True
-        return False
-    except Exception as e:
-        logger.error(f"Segment download error: {str(e)}")
-        return False
+        playlist_url = url
+        # Shared pool: connections to the CDN stay open between segments and jobs
+        session = await http_client.get_session()
 
-async def process_m3u8(url, output_file, status_msg):
-    """Process M3U8 playlist with rate-limited updates"""
-    try:
-        connector = aiohttp.TCPConnector(limit=MAX_CONCURRENT_DOWNLOADS)
-        timeout = aiohttp.ClientTimeout(total=None, connect=10, sock_connect=10, sock_read=10)
-
-        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
-            # Fetch playlist
-            async with session.get(url, headers=HEADERS) as response:
-                if response.status != 200:
-                    raise Exception(f"Failed to fetch playlist: {response.status}")
+        # Fetch playlist
+        async with session.get(url, headers=HEADERS) as response:
+            if response.status != 200:
+                raise Exception(f"Failed to fetch playlist: {response.status}")
+            content = await response.text()
+
+        playlist = m3u8.loads(content)
+
+        # Handle master playlist
+        bandwidth = None
+        if playlist.playlists:
+            variant_uri, bandwidth = select_variant(playlist, audio_only, height)
+            variant_url = urljoin(url, variant_uri)
+            logger.info(f"Picked {variant_label(audio_only, height)} rendition {variant_url} ({bandwidth} bps)")
+            async with session.get(variant_url, headers=HEADERS) as response:
                 content = await response.text()
-
-            playlist = m3u8.loads(content)
-
-            # Handle master playlist
-            if playlist.playlists:
-                variant = max(playlist.playlists, key=lambda p: p.stream_info.bandwidth if p.stream_info else 0)
-                variant_url = urljoin(url, variant.uri)
-                async with session.get(variant_url, headers=HEADERS) as response:
-                    content = await response.text()
-                    playlist = m3u8.loads(content)
-                    url = variant_url
-
-            if not playlist.segments:
-                raise Exception("No segments found in playlist")
-
-            total_segments = len(playlist.segments)
-            base_url = url.rsplit('/', 1)[0] + '/'
-
+                playlist = m3u8.loads(content)
+                url = variant_url
+
+        if not playlist.segments:
+            raise Exception("No segments found in playlist")
+
+        total_segments = len(playlist.segments)
+        base_url = url.rsplit('/', 1)[0] + '/'
+        # No ENDLIST: the playlist is still growing, unless it declares itself VOD
+        live = None
+        if not playlist.is_endlist and (playlist.playlist_type or '').lower() != 'vod':
+            live = LivePlaylist(session, url, playlist, min(live_cap or LIVE_MAX_SECONDS, LIVE_MAX_SECONDS))
+            live_recordings.add(output_file)
+            await safe_edit_message(
+                status_msg,
+                f"🔴 Live stream found\n"
+                f"⏳ Recording until it ends, at most {time_formatter(live.max_seconds)}..."
+            )
+        else:
             await safe_edit_message(
                 status_msg,
                 f"📥 Found {total_segments} segments\n"
                 "⏳ Starting download..."
             )
 
-            # Clean up existing file
+        # Resume a partial download of the same playlist, otherwise start clean;
+        # a live window has moved on by the next run, so recordings never resume
+        manifest = None if output_format or live else load_manifest(output_file, playlist_url, url)
+        next_idx, offset = resume_point(manifest)
+        if manifest is None or not os.path.exists(output_file) or os.path.getsize(output_file) < offset:
             if os.path.exists(output_file):
                 os.remove(output_file)
+            manifest = {'url': playlist_url, 'variant_url': url, 'segments': {}}
+            next_idx = 1
+        elif next_idx > 1:
+            logger.info(f"Resuming {output_file} at segment {next_idx}/{total_segments}")
+            await safe_edit_message(
+                status_msg,
+                f"♻️ Resuming download at segment {next_idx}/{total_segments}"
+            )
 
-            # Download segments with progress bar
-            start_time = time.time()
-            last_update_time = 0
-            for idx, segment in enumerate(playlist.segments, 1):
-                segment_url = urljoin(base_url, segment.uri)
-                success = await download_segment(session, segment_url, output_file)
+        # Hold disk space for the whole output before writing any of it
+        if live:
+            duration = live.max_seconds
+        else:
+            duration = sum(segment.duration or 0 for segment in playlist.segments) or None
+        expected = estimate_size(bandwidth, duration)
+        if expected:
+            # A staged .ts is converted next to itself, so it needs room twice
+            await reserve_space(
+                expected if output_format else 2 * expected - (offset if next_idx > 1 else 0), output_file
+            )
+            if parts_needed(expected) > 1:
+                await safe_edit_message(
+                    status_msg,
+                    f"📦 Expected size ~{humanbytes(expected)}, over Telegram's limit\n"
+                    f"✂️ It will be sent in ~{parts_needed(expected)} parts"
+                )
 
-                if not success:
-                    logger.error(f"Failed to download segment {idx}")
-                    continue
+        if output_format:
+            sink = FfmpegPipeSink(output_file, output_format)
+        else:
+            sink = SegmentSink(output_file, None if live else manifest)
+
+        # Download segments with progress bar
+        start_time = time.time()
+        media_sequence = playlist.media_sequence or 0
+        segment_urls = [
+            (idx, urljoin(base_url, segment.uri), segment_key(segment, media_sequence + idx - 1, base_url))
+            for idx, segment in enumerate(playlist.segments, 1)
+            if idx >= next_idx
+        ]
+
+        async def segment_batches():
+            if live:
+                async for batch in live.batches():
+                    yield batch
+            else:
+                yield segment_urls
+
+        done = 0
+        # Shared by every live refresh, so the AES key is fetched once per job
+        keys = KeyCache(session)
+
+        def progress_text(idx):
+            now = time.time()
+            speed = sink.bytes_written / (now - start_time) if now > start_time else 0
+            if live:
+                return (
+                    f"🔴 Recording live stream\n"
+                    f"🔄 {idx} segments, {time_formatter(live.seconds)} of at most {time_formatter(live.max_seconds)}\n"
+                    f"💾 {humanbytes(sink.bytes_written)}\n"
+                    f"🚀 Speed: {humanbytes(speed)}/s"
+                )
+            progress = idx / total_segments
+            progress_bar = create_progress_bar(idx, total_segments)
+            eta = (total_segments - idx) * (now - start_time) / done
+            return (
+                f"📥 Downloading segments\n"
+                f"{progress_bar}\n"
+                f"🔄 {idx}/{total_segments} ({progress*100:.1f}%)\n"
+                f"💾 {humanbytes(sink.bytes_written)}\n"
+                f"🚀 Speed: {humanbytes(speed)}/s\n"
+                f"⏱ ETA: {time_formatter(eta)}"
+            )
 
-                now = time.time()
-                if (idx % 10 == 0 or idx == total_segments) and now - last_update_time >= MIN_DELAY_BETWEEN_UPDATES:
-                    progress = idx / total_segments
-                    progress_bar = create_progress_bar(idx, total_segments)
-                    speed = idx / (now - start_time) if now > start_time else 0
-                    eta = (total_segments - idx) / speed if speed > 0 else 0
-
-                    try:
-                        await safe_edit_message(
-                            status_msg,
-                            f"📥 Downloading segments\n"
-                            f"{progress_bar}\n"
-                            f"🔄 {idx}/{total_segments} ({progress*100:.1f}%)\n"
-                            f"🚀 Speed: {speed:.1f} segments/s\n"
-                            f"⏱ ETA: {time_formatter(eta)}"
-                        )
-                        last_update_time = now
-                    except Exception as e:
-                        if "FLOOD_WAIT" in str(e):
-                            await handle_flood_wait(e, status_msg)
-                            last_update_time = time.time()
-
-            # Verify download
-            if not os.path.exists(output_file) or os.path.getsize(output_file) == 0:
-                raise Exception("Download failed - Empty file")
+        async with sink:
+            async for batch in segment_batches():
+                # Closed right away on cancel or error, which stops the in-flight fetches
+                fetched = fetch_segments_ordered(session, batch, concurrency, stats=stats, keys=keys)
+                async with aclosing(fetched):
+                    async for idx, chunks in fetched:
+                        if not await sink.write_segment(idx, chunks):
+                            logger.error(f"Failed to download segment {idx}")
+                            if len(sink.failed) > failure_budget:
+                                # Let a resumed job start again from the first hole
+                                sink.rollback(sink.failed[0])
+                                logger.error(f"Segment stats for {output_file}: {stats.summary()}")
+                                raise Exception(
+                                    f"{len(sink.failed)} segments failed "
+                                    f"(budget {failure_budget}), download aborted"
+                                )
+                            continue
+                        done += 1
 
-            return output_file
+                        # Coalesced by the limiter, so the download never waits on Telegram
+                        limiter.submit_edit(status_msg, progress_text(idx), reply_markup=cancel_button())
+
+        if live:
+            logger.info(
+                f"Recorded {live.seconds:.0f}s of {url}: {live.refreshes} playlist refreshes, "
+                f"{live.not_modified} not modified"
+            )
+
+        logger.info(f"Segment stats for {output_file}: {stats.summary()}")
+
+        # Verify download
+        if not os.path.exists(output_file) or os.path.getsize(output_file) == 0:
+            raise Exception("Download failed - Empty file")
+
+        if not output_format:
+            remove_manifest(output_file)
+        if status_msg:
+            await safe_edit_message(
+                status_msg,
+                f"✅ Downloaded {humanbytes(os.path.getsize(output_file))}\n📊 {stats.summary()}"
+            )
+        return output_file
 
     except Exception as e:
         logger.error(f"M3U8 processing error: {str(e)}")
+        forget_output(output_file)
         if status_msg:
-            await safe_edit_message(status_msg, f"❌ Error: {str(e)}")
+            details = f"\n📊 {stats.summary()}" if stats.segments else ""
+            await safe_edit_message(status_msg, f"❌ Error: {str(e)}{details}", cancellable=False)
         return None
 
-async def download_pdf(session, url, output_path):
-    """Download PDF file with better error handling"""
-    try:
-        logger.info(f"Attempting to download PDF from: {url}")
-        async with session.get(url, headers=HEADERS) as response:
-            logger.info(f"PDF download response status: {response.status}")
-            if response.status == 200:
-                content = await response.read()
-                if len(content) > 0:
-                    async with aiofiles.open(output_path, 'wb') as f:
-                        await f.write(content)
-                    logger.info(f"PDF downloaded successfully: {output_path} ({len(content)} bytes)")
-                    return True
-                else:
-                    logger.error("PDF download failed: Empty content")
-                    return False
-            else:
-                logger.error(f"PDF download failed: HTTP {response.status}")
-                return False
-    except Exception as e:
-        logger.error(f"PDF download error: {str(e)}")
-        return False
-
-def is_pdf_url(url):
-    """Check if URL likely points to a PDF"""
-    url_lower = url.lower()
-    return (url_lower.endswith('.pdf') or 
-            'pdf' in url_lower or 
-            'application/pdf' in url_lower or
-            '.pdf?' in url_lower)
-
-def is_video_url(url):
-    """Check if URL likely points to a video (M3U8)"""
-    return '.m3u8' in url.lower()
-
-async def parse_text_file(file_path):
-    """Improved text file parser with better PDF recognition"""
-    entries = []
+async def download_media(url, base_name, output_format, status_msg, title=None, height=None, live_cap=None):
+    """Download an M3U8 stream and convert it, reusing a cached copy when there is one"""
+    key = cache_key(url, variant_label(output_format == 'mp3', height), output_format)
+    result_file = await cache.fetch(
+        key,
+        lambda: fetch_media(url, base_name, output_format, status_msg, title, height, live_cap),
+        dest_dir=work_path()
+    )
+    if not reusable(result_file):
+        # Only known once the playlist was read; the next request must record afresh
+        cache.discard(key)
+    track_temp(result_file)
+    return result_file
+
+async def fetch_media(url, base_name, output_format, status_msg, title=None, height=None, live_cap=None):
+    """Download an M3U8 stream and convert it, piping into ffmpeg when enabled"""
+    audio_only = output_format == 'mp3'
+    if STREAM_CONVERSION:
+        return await process_m3u8(
+            url, work_path(f"{base_name}.{output_format}"), status_msg,
+            output_format=output_format, audio_only=audio_only, height=height, live_cap=live_cap
+        )
 
+    # Staged downloads live outside the job directory so a later job can resume them
+    downloaded_file = await process_m3u8(
+        url, workspaces.partial_path(f"{base_name}.ts"), status_msg,
+        audio_only=audio_only, height=height, live_cap=live_cap
+    )
+    if not downloaded_file or not os.path.exists(downloaded_file):
+        return None
+    label = f": {title}" if title else "..."
+    await safe_edit_message(status_msg, f"🔄 Converting to {output_format.upper()}{label}")
+    return await convert_to_format_fast(downloaded_file, output_format, status_msg=status_msg)
+
+async def convert_to_format_fast(input_file, output_format, enable_streaming=True, status_msg=None):
+    """Fast conversion with streaming optimization, remuxing when codecs allow"""
+    # Named after the input, so parallel conversions can't collide
+    name = os.path.splitext(os.path.basename(input_file))[0]
+    output_file = work_path(f"converted_{name}.{output_format}")
+    track_temp(output_file)
     try:
-        async with aiofiles.open(file_path, 'r', encoding='utf-8') as file:
-            content = await file.read()
-            lines = [line.strip() for line in content.split('\n') if line.strip()]
-
-        logger.info(f"📄 Total lines in file: {len(lines)}")
-
-        # First pass: identify all URLs and their types
-        url_info = []
-        for idx, line in enumerate(lines):
-            if 'http' in line:
-                # Extract URL from line (handle various formats)
-                url_match = re.search(r'https?://[^\s<>"\[\]]+', line)
-                if url_match:
-                    url = url_match.group()
-                    # Get text before URL as potential title
-                    title_part = line[:url_match.start()].strip()
-                    # Clean up title (remove common separators)
-                    title_part = re.sub(r'[:\-\|]+$', '', title_part).strip()
-
-                    url_info.append({
-                        'line_idx': idx,
-                        'line': line,
-                        'url': url,
-                        'title_part': title_part,
-                        'is_video': is_video_url(url),
-                        'is_pdf': is_pdf_url(url)
-                    })
-
-        logger.info(f"📊 Found {len(url_info)} URLs")
-
-        # Second pass: group content by video entries
-        current_video = None
-
-        for i, line in enumerate(lines):
-            line_lower = line.lower()
-
-            # Check if this line contains a video URL
-            video_url_info = None
-            for url_info_item in url_info:
-                if url_info_item['line_idx'] == i and url_info_item['is_video']:
-                    video_url_info = url_info_item
-                    break
-
-            if video_url_info:
-                # Found a video URL - create new entry
-                title = video_url_info['title_part']
-
-                # If no title in URL line, look for title in previous lines
-                if not title:
-                    # Look back up to 3 lines for a title
-                    for j in range(max(0, i-3), i):
-                        prev_line = lines[j].strip()
-                        if prev_line and not any(url_item['line_idx'] == j for url_item in url_info):
-                            # This line doesn't contain a URL, might be a title
-                            if not prev_line.lower().startswith(('pdf', 'note', 'link')):
-                                title = prev_line
-                                break
-
-                if not title:
-                    title = f"Video_{len(entries)+1}"
-
-                current_video = {
-                    'type': 'video',
-                    'title': title,
-                    'url': video_url_info['url'],
-                    'pdfs': []
-                }
-                entries.append(current_video)
-                logger.info(f"🎥 Found video: {title[:50]}...")
-                continue
-
-            # Check if this line contains a PDF URL
-            pdf_url_info = None
-            for url_info_item in url_info:
-                if url_info_item['line_idx'] == i and url_info_item['is_pdf']:
-                    pdf_url_info = url_info_item
-                    break
-
-            if pdf_url_info and current_video:
-                # Found a PDF URL - associate with current video
-                pdf_title = pdf_url_info['title_part']
-
-                # If no title in URL line, look for title in previous lines or use default
-                if not pdf_title:
-                    # Look back up to 2 lines for a PDF title
-                    for j in range(max(0, i-2), i):
-                        prev_line = lines[j].strip()
-                        if prev_line and not any(url_item['line_idx'] == j for url_item in url_info):
-                            # Check if this looks like a PDF title
-                            if (prev_line.lower().startswith('pdf') or 
-                                'pdf' in prev_line.lower() or
-                                prev_line.startswith('[') or
-                                len(prev_line) > 10):  # Reasonable title length
-                                pdf_title = prev_line
-                                break
-
-                if not pdf_title:
-                    pdf_title = f"PDF for {current_video['title']}"
-
-                # Clean PDF title
-                pdf_title = re.sub(r'^pdf[\s\-:]*', '', pdf_title, flags=re.IGNORECASE).strip()
-
-                current_video['pdfs'].append({
-                    'title': pdf_title,
-                    'url': pdf_url_info['url']
-                })
-                logger.info(f"📚 Associated PDF: {pdf_title[:50]}... with video: {current_video['title'][:30]}...")
-                continue
-
-            # Check for standalone PDF indicators (lines that mention PDF but don't have URLs)
-            if (current_video and 
-                ('pdf' in line_lower or 'document' in line_lower) and 
-                'http' not in line and
-                len(line) > 5):  # Reasonable length for a title
-
-                # This might be a PDF title, check next few lines for URL
-                for j in range(i+1, min(len(lines), i+3)):
-                    next_line = lines[j].strip()
-                    if 'http' in next_line:
-                        # Check if this URL is a PDF
-                        for url_info_item in url_info:
-                            if url_info_item['line_idx'] == j and url_info_item['is_pdf']:
-                                # Found matching PDF URL
-                                pdf_title = re.sub(r'^pdf[\s\-:]*', '', line, flags=re.IGNORECASE).strip()
-                                current_video['pdfs'].append({
-                                    'title': pdf_title,
-                                    'url': url_info_item['url']
-                                })
-                                logger.info(f"📚 Found PDF title-URL pair: {pdf_title[:50]}...")
-                                break
-                        break
-
-        # Summary
-        total_videos = len(entries)
-        total_pdfs = sum(len(entry['pdfs']) for entry in entries)
-        logger.info(f"📊 FINAL PARSING RESULT:")
-        logger.info(f"   📹 Videos found: {total_videos}")
-        logger.info(f"   📚 PDFs found: {total_pdfs}")
-
-        # Debug output for first few entries
-        for idx, entry in enumerate(entries[:3]):
-            logger.info(f"   Entry {idx+1}: {entry['title'][:40]}... ({len(entry['pdfs'])} PDFs)")
-            for p_idx, pdf in enumerate(entry['pdfs']):
-                logger.info(f"      PDF {p_idx+1}: {pdf['title'][:40]}...")
-
-        return entries
-
-    except Exception as e:
-        logger.error(f"Error parsing file: {str(e)}")
-        return []
+        try:
+            info = await probe_media(input_file)
+            remux = can_remux(info, output_format)
+        except Exception as e:
+            logger.error(f"Probe failed, falling back to transcoding: {str(e)}")
+            info = {'duration': None}
+            remux = False
+
+        async def report(done, duration):
+            if status_msg:
+                await progress(
+                    done, duration, status_msg, start_time,
+                    f"🔄 Converting to {output_format.upper()}...",
+                    format_realtime
+                )
 
-async def convert_to_format_fast(input_file, output_format, enable_streaming=True):
-    """Fast conversion with streaming optimization"""
-    timestamp = int(time.time())
-    output_file = f"converted_{timestamp}.{output_format}"
-    try:
-        if output_format == 'mp3':
-            # Fast MP3 extraction with optimal settings
-            cmd = [
-                'ffmpeg', '-i', input_file,
-                '-vn',  # No video
-                '-acodec', 'libmp3lame',
-                '-ab', '128k',  # Reduced bitrate for faster encoding
-                '-ar', '44100',
-                '-ac', '2',  # Stereo
-                '-threads', '0',  # Use all available threads
-                '-y',
-                output_file
-            ]
-        elif output_format == 'mp4':
-            # Optimized MP4 for streaming with fast encoding
-            cmd = [
-                'ffmpeg', '-i', input_file,
-                '-c:v', 'libx264',
-                '-preset', 'ultrafast',  # Fastest encoding preset
-                '-crf', '28',  # Reasonable quality with fast encoding
-                '-profile:v', 'baseline',  # Better compatibility
-                '-level', '3.1',
-                '-c:a', 'aac',
-                '-b:a', '128k',
-                '-ac', '2',
-                '-movflags', '+faststart',  # Enable streaming
-                '-threads', '0',  # Use all available threads
-                '-y',
-                output_file
-            ]
-        else:
-            # Copy streams for other formats (fastest)
-            cmd = [
-                'ffmpeg', '-i', input_file,
-                '-c', 'copy',
-                '-movflags', '+faststart',  # Enable streaming if container supports it
-                '-threads', '0',
-                '-y',
-                output_file
-            ]
-        logger.info(f"Starting conversion with command: {' '.join(cmd)}")
-        # Run FFmpeg with optimized settings
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await process.communicate()
-        if process.returncode != 0:
-            logger.error(f"FFmpeg error: {stderr.decode()}")
+        async with scheduler.slot(job_cost(info['duration'], remux)) as threads:
+            cmd = build_convert_cmd(input_file, output_file, output_format, remux, threads, progress=True)
+            logger.info(f"Starting conversion with command: {' '.join(cmd)}")
+            # Run FFmpeg with optimized settings
+            start_time = time.time()
+            returncode, stderr = await run_ffmpeg(cmd, info['duration'], report)
+        if returncode != 0:
+            logger.error(f"FFmpeg error: {stderr}")
+            forget_output(input_file)
             return None
         if os.path.exists(output_file) and os.path.getsize(output_file) > 0:
             # Remove original file to save space
             if os.path.exists(input_file):
                 os.remove(input_file)
+            if not reusable(input_file):
+                live_recordings.discard(input_file)
+                live_recordings.add(output_file)
+            move_space(input_file, output_file)
             return output_file
         else:
             logger.error("Conversion failed - output file not created or empty")
+            forget_output(input_file)
             return None
     except Exception as e:
         logger.error(f"Conversion error: {str(e)}")
+        forget_output(input_file)
         return None
 
+async def upload_entry(message, entry, clean_title, result_file, output_format, status_msg, pdf_fetches,
+                       content_key, resend=False, height=None, live_cap=None, index=0):
+    """Upload a batch entry's converted file followed by its PDFs.
+
+    With `resend` the video was delivered before and goes out by file_id;
+    if Telegram no longer accepts it, the video is downloaded again.
+    """
+    format_emoji = "🎵" if output_format == 'mp3' else "🎥"
+    if resend:
+        if await file_ids.send(message, content_key, f"{format_emoji} {clean_title}"):
+            logger.info(f"✅ Resent cached video: {clean_title}")
+        else:
+            base_name = entry_name(message.from_user.id, index, entry['url'])
+            result_file = await download_media(
+                entry['url'], base_name, output_format, status_msg, clean_title, height, live_cap
+            )
+
+    async def send(path, title):
+        start_time = time.time()
+        # Use reply_video for MP4 files to enable streaming
+        if output_format == 'mp4':
+            return await message.reply_video(
+                video=path,
+                caption=f"{format_emoji} {title}",
+                file_name=f"{title}.{output_format}",
+                supports_streaming=True,  # Enable streaming
+                progress=progress,
+                progress_args=(
+                    status_msg,
+                    start_time,
+                    f"📤 Uploading {output_format.upper()}: {title}"
+                )
+            )
+        # Use reply_document for MP3 and other formats
+        return await message.reply_document(
+            path,
+            caption=f"{format_emoji} {title}",
+            file_name=f"{title}.{output_format}",
+            progress=progress,
+            progress_args=(
+                status_msg,
+                start_time,
+                f"📤 Uploading {output_format.upper()}: {title}"
+            )
+        )
+
+    if result_file and os.path.exists(result_file):
+        try:
+            if os.path.getsize(result_file) > MAX_UPLOAD_BYTES:
+                # Too big for one message: each part is sent as soon as it's cut
+                await safe_edit_message(status_msg, f"✂️ Splitting {clean_title} into parts...")
+                parts = await send_in_parts(result_file, lambda part, index: send(part, f"{clean_title} (Part {index})"))
+                logger.info(f"✅ Successfully uploaded video in {parts} parts: {clean_title}")
+            else:
+                sent = await send(result_file, clean_title)
+                if reusable(result_file):
+                    file_ids.put(content_key, sent)
+                logger.info(f"✅ Successfully uploaded video: {clean_title}")
+        except Exception as e:
+            logger.error(f"Error uploading video: {str(e)}")
+        finally:
+            if os.path.exists(result_file):
+                os.remove(result_file)
+            forget_output(result_file)
+
+    # Upload associated PDFs, prefetched while the video was being processed
+    for pdf_idx, (pdf_entry, (pdf_path, fetch)) in enumerate(zip(entry['pdfs'], pdf_fetches)):
+        pdf_clean_title = clean_filename(pdf_entry['title'])
+
+        if not fetch.done():
+            await safe_edit_message(
+                status_msg,
+                f"📚 Downloading PDF {pdf_idx+1}/{len(entry['pdfs'])}\n"
+                f"Video: {clean_title}\n"
+                f"PDF: {pdf_clean_title}"
+            )
+
+        if await fetch:
+            start_time = time.time()
+            try:
+                await message.reply_document(
+                    pdf_path,
+                    caption=f"📚 {pdf_clean_title}\n📹 Related to: {clean_title}",
+                    file_name=f"{pdf_clean_title}.pdf",
+                    progress=progress,
+                    progress_args=(
+                        status_msg,
+                        start_time,
+                        f"📤 Uploading PDF: {pdf_clean_title}"
+                    )
+                )
+                logger.info(f"✅ Successfully uploaded PDF: {pdf_clean_title}")
+            except Exception as e:
+                logger.error(f"Error uploading PDF: {str(e)}")
+            finally:
+                if os.path.exists(pdf_path):
+                    os.remove(pdf_path)
+        else:
+            logger.error(f"Failed to download PDF: {pdf_entry['url']}")
+            await message.reply_text(f"❌ Failed to download PDF: {pdf_clean_title}")
+
+async def run_batch_pipeline(message, entry_queue, output_format, pdfs, parsed, reader, height=None, live_cap=None):
+    """Run batch entries through download -> convert -> upload stages.
+
+    Each stage has one worker fed by a small bounded queue, so entry k+1
+    downloads while entry k converts and entry k-1 uploads, and files still
+    reach the chat in batch-file order. With streaming conversion ffmpeg
+    already runs during the download and the convert stage passes through.
+    An entry's PDFs start downloading through `pdfs` (a PdfPrefetcher) as
+    soon as the entry is picked up. Entries Telegram already has, or that are
+    in the download cache, skip straight to upload.
+    """
+    claims = set()  # Cache keys this batch is producing
+    convert_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    upload_queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    fetch_status = await message.reply_text("📥 Downloads: waiting for the first entry...", reply_markup=cancel_button())
+    convert_status = None if STREAM_CONVERSION else await message.reply_text("🔄 Conversions: idle", reply_markup=cancel_button())
+    upload_status = await message.reply_text("📤 Uploads: idle", reply_markup=cancel_button())
+
+    async def fetch_stage():
+        index = 0
+        while True:
+            entry = await entry_queue.get()
+            if entry is None:
+                break
+            index += 1
+            job = {
+                'index': index, 'entry': entry, 'title': clean_filename(entry['title']), 'file': None,
+                'content_key': cache_key(entry['url'], variant_label(output_format == 'mp3', height), output_format), 'cache_key': None, 'resend': False
+            }
+            # Per entry: a batch may list the same lecture twice
+            job['pdfs'] = pdfs.schedule(
+                entry['pdfs'], work_path(f"temp_pdf_{message.from_user.id}_{index}_{job_key(entry['url'])}")
+            )
+            try:
+                total_videos = f"{parsed['videos']}{'' if reader.done() else '+'}"
+                await safe_edit_message(
+                    fetch_status,
+                    f"📥 Downloading {index}/{total_videos}\n"
+                    f"Title: {job['title']}\n"
+                    f"Associated PDFs: {len(entry['pdfs'])}"
+                )
+                key = job['content_key']
+                if file_ids.get(key):
+                    # Already on Telegram, the upload stage resends it by file_id
+                    job['resend'] = True
+                    await convert_queue.put(job)
+                    continue
+                job['file'] = await cache.acquire(key, dest_dir=work_path())
+                track_temp(job['file'])
+                if job['file']:
+                    await convert_queue.put(job)
+                    continue
+                job['cache_key'] = key
+                claims.add(key)
+
+                base_name = entry_name(message.from_user.id, index, entry['url'])
+                if STREAM_CONVERSION:
+                    job['file'] = await process_m3u8(
+                        entry['url'], work_path(f"{base_name}.{output_format}"), fetch_status,
+                        output_format=output_format, audio_only=output_format == 'mp3', height=height,
+                        live_cap=live_cap
+                    )
+                else:
+                    job['file'] = await process_m3u8(
+                        entry['url'], workspaces.partial_path(f"{base_name}.ts"), fetch_status,
+                        audio_only=output_format == 'mp3', height=height, live_cap=live_cap
+                    )
+            except Exception as e:
+                logger.error(f"Error downloading entry {index}: {str(e)}")
+                await message.reply_text(f"❌ Error processing entry {index}: {str(e)}")
+            await convert_queue.put(job)
+        await convert_queue.put(None)
+
+    async def convert_stage():
+        while True:
+            job = await convert_queue.get()
+            if job is None:
+                break
+            # Only fresh downloads need converting; cache hits are already in the output format
+            if not STREAM_CONVERSION and job['cache_key'] and job['file'] and os.path.exists(job['file']):
+                downloaded_file = job['file']
+                job['file'] = None
+                try:
+                    await safe_edit_message(
+                        convert_status,
+                        f"🔄 Converting {job['index']} to {output_format.upper()}: {job['title']}"
+                    )
+                    job['file'] = await convert_to_format_fast(downloaded_file, output_format, status_msg=convert_status)
+                except Exception as e:
+                    logger.error(f"Error converting entry {job['index']}: {str(e)}")
+                    await message.reply_text(f"❌ Error processing entry {job['index']}: {str(e)}")
+                finally:
+                    if os.path.exists(downloaded_file):
+                        os.remove(downloaded_file)
+            if job['cache_key']:
+                if job['file'] and os.path.exists(job['file']) and reusable(job['file']):
+                    await cache.put(job['cache_key'], job['file'])
+                cache.release(job['cache_key'])
+                claims.discard(job['cache_key'])
+            await upload_queue.put(job)
+        await upload_queue.put(None)
+
+    async def upload_stage():
+        last_upload = None
+        while True:
+            job = await upload_queue.get()
+            if job is None:
+                break
+            # Space out deliveries without holding up the stages behind us
+            if last_upload is not None:
+                wait = MIN_DELAY_BETWEEN_ENTRIES - (time.time() - last_upload)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            try:
+                await upload_entry(
+                    message, job['entry'], job['title'], job['file'], output_format, upload_status, job['pdfs'],
+                    job['content_key'], job['resend'], height, live_cap, job['index']
+                )
+            except Exception as e:
+                logger.error(f"Error uploading entry {job['index']}: {str(e)}")
+                await message.reply_text(f"❌ Error processing entry {job['index']}: {str(e)}")
+            finally:
+                if job['file'] and os.path.exists(job['file']):
+                    os.remove(job['file'])
+                forget_output(job['file'])
+                PdfPrefetcher.discard(job['pdfs'])
+            last_upload = time.time()
+
+    stages = [asyncio.create_task(stage()) for stage in (fetch_stage, convert_stage, upload_stage)]
+    try:
+        await asyncio.gather(*stages)
+    finally:
+        # A stage that died unexpectedly must not leave the others waiting forever
+        for stage in stages:
+            stage.cancel()
+        for key in claims:
+            cache.release(key)
+        for status in (fetch_status, convert_status, upload_status):
+            if status:
+                try:
+                    await status.delete()
+                except Exception:
+                    pass
+
 @Client.on_message((filters.regex(r'https?://[^\s<>"]+?\.m3u8(?:\?[^\s<>"]*)?') | filters.document) & filters.private)
 async def handle_m3u8(client, message):
+    """Queue M3U8 URLs or text files behind other users' jobs"""
+    if message.document and message.document.mime_type != "text/plain":
+        return
+    label = f"M3U8 batch {message.document.file_name}" if message.document else "M3U8 stream"
+    await enqueue(message, message.from_user.id, label, lambda: run_m3u8_job(client, message))
+
+async def run_m3u8_job(client, message):
     """Handle M3U8 URLs or text files with streaming support"""
     try:
         # Determine output format - default to MP4 for videos, MP3 if specifically requested
         output_format = 'mp3' if message.reply_to_message and message.reply_to_message.text and '/mp3' in message.reply_to_message.text else 'mp4'
+        height = requested_height(message)
+        live_cap = requested_live_cap(message)
 
         if message.document and message.document.mime_type == "text/plain":
-            status = await message.reply_text("📄 Reading and parsing file...")
-            file = await message.download()
-            entries = await parse_text_file(file)
-            os.remove(file)
+            status_msg = await message.reply_text(
+                "📄 Reading file...\n"
+                "⏳ Downloads start in order as soon as the first entry is parsed",
+                reply_markup=cancel_button()
+            )
+
+            # Parse the file while it streams in and hand over entries as they complete
+            entry_queue = asyncio.Queue(maxsize=ENTRY_QUEUE_SIZE)
+            parsed = {'videos': 0, 'pdfs': 0}
+
+            async def read_entries():
+                try:
+                    async for entry in iter_entries(iter_media_lines(client, message)):
+                        parsed['videos'] += 1
+                        parsed['pdfs'] += len(entry['pdfs'])
+                        await entry_queue.put(entry)
+                except Exception as e:
+                    logger.error(f"Error parsing file: {str(e)}")
+                    await message.reply_text(f"❌ Error reading file: {str(e)}")
+                await entry_queue.put(None)
+
+            reader = asyncio.create_task(read_entries())
+            try:
+                pdfs = PdfPrefetcher(await http_client.get_session())
+                try:
+                    await run_batch_pipeline(
+                        message, entry_queue, output_format, pdfs, parsed, reader, height, live_cap
+                    )
+                finally:
+                    pdfs.close()
+            finally:
+                reader.cancel()
 
-            if not entries:
-                await message.reply_text("❌ No valid video entries found in file.")
+            if not parsed['videos']:
+                await safe_edit_message(status_msg, "❌ No valid video entries found in file.", cancellable=False)
                 return
 
-            total_videos = len(entries)
-            total_pdfs = sum(len(entry['pdfs']) for entry in entries)
+            await safe_edit_message(
+                status_msg,
+                f"✅ Processing complete!\n📹 {parsed['videos']} videos\n📚 {parsed['pdfs']} PDFs",
+                cancellable=False
+            )
 
-            status_msg = await message.reply_text(
-                f"🔍 Found {total_videos} videos and {total_pdfs} PDFs\n"
-                "⏳ Starting downloads in order..."
+        else:  # Single URL
+            status_msg = await message.reply_text("⏳ Processing single URL...", reply_markup=cancel_button())
+            timestamp = int(datetime.now().timestamp())
+            base_name = f"video_{message.from_user.id}_{job_key(message.text)}"
+            content_key = cache_key(message.text, variant_label(output_format == 'mp3', height), output_format)
+            format_emoji = "🎵" if output_format == 'mp3' else "🎥"
+
+            # Delivered before: resend by file_id instead of fetching it again
+            if await file_ids.send(message, content_key, f"{format_emoji} {'Audio' if output_format == 'mp3' else 'Video'}"):
+                await status_msg.delete()
+                return
+
+            result_file = await download_media(
+                message.text, base_name, output_format, status_msg, height=height, live_cap=live_cap
             )
 
-            async with aiohttp.ClientSession() as session:
-                for i, entry in enumerate(entries):
-                    try:
-                        title = entry['title']
-                        url = entry['url']
-                        clean_title = clean_filename(title)
-
-                        await safe_edit_message(
-                            status_msg,
-                            f"📥 Processing {i+1}/{total_videos}\n"
-                            f"Title: {clean_title}\n"
-                            f"Associated PDFs: {len(entry['pdfs'])}"
-                        )
-
-                        # Download video
-                        ts_file = f"temp_{message.from_user.id}_{int(datetime.now().timestamp())}.ts"
-                        downloaded_file = await process_m3u8(url, ts_file, status_msg)
-
-                        if downloaded_file and os.path.exists(downloaded_file):
-                            await safe_edit_message(status_msg, f"🔄 Converting to {output_format.upper()}: {clean_title}")
-                            # You may want to use convert_to_format_fast here:
-                            # result_file = await convert_to_format_fast(downloaded_file, output_format)
-                            # If you have an old convert_to_format, keep as is:
-                            result_file = await convert_to_format_fast(downloaded_file, output_format)
-
-                            if result_file and os.path.exists(result_file):
-                                start_time = time.time()
-                                try:
-                                    format_emoji = "🎵" if output_format == 'mp3' else "🎥"
-
-                                    # Use reply_video for MP4 files to enable streaming
-                                    if output_format == 'mp4':
-                                        await message.reply_video(
-                                            video=result_file,
-                                            caption=f"{format_emoji} {clean_title}",
-                                            file_name=f"{clean_title}.{output_format}",
-                                            supports_streaming=True,  # Enable streaming
-                                            progress=progress,
-                                            progress_args=(
-                                                status_msg,
-                                                start_time,
-                                                f"📤 Uploading {output_format.upper()}: {clean_title}"
-                                            )
-                                        )
-                                    else:
-                                        # Use reply_document for MP3 and other formats
-                                        await message.reply_document(
-                                            result_file,
-                                            caption=f"{format_emoji} {clean_title}",
-                                            file_name=f"{clean_title}.{output_format}",
-                                            progress=progress,
-                                            progress_args=(
-                                                status_msg,
-                                                start_time,
-                                                f"📤 Uploading {output_format.upper()}: {clean_title}"
-                                            )
-                                        )
-                                    logger.info(f"✅ Successfully uploaded video: {clean_title}")
-                                except Exception as e:
-                                    logger.error(f"Error uploading video: {str(e)}")
-                                    if "FLOOD_WAIT" in str(e):
-                                        await handle_flood_wait(e, status_msg)
-                                        continue
-                                finally:
-                                    if os.path.exists(result_file):
-                                        os.remove(result_file)
-
-                        # Process associated PDFs
-                        for pdf_idx, pdf_entry in enumerate(entry['pdfs']):
-                            pdf_title = pdf_entry['title']
-                            pdf_url = pdf_entry['url']
-                            pdf_clean_title = clean_filename(pdf_title)
-
-                            await safe_edit_message(
-                                status_msg,
-                                f"📚 Downloading PDF {pdf_idx+1}/{len(entry['pdfs'])}\n"
-                                f"Video: {clean_title}\n"
-                                f"PDF: {pdf_clean_title}"
-                            )
+            if result_file and os.path.exists(result_file):
+                start_time = time.time()
+                file_size = os.path.getsize(result_file)
 
-                            pdf_path = f"temp_pdf_{message.from_user.id}_{int(datetime.now().timestamp())}_{pdf_idx}.pdf"
-
-                            if await download_pdf(session, pdf_url, pdf_path):
-                                if os.path.exists(pdf_path) and os.path.getsize(pdf_path) > 0:
-                                    start_time = time.time()
-                                    try:
-                                        await message.reply_document(
-                                            pdf_path,
-                                            caption=f"📚 {pdf_clean_title}\n📹 Related to: {clean_title}",
-                                            file_name=f"{pdf_clean_title}.pdf",
-                                            progress=progress,
-                                            progress_args=(
-                                                status_msg,
-                                                start_time,
-                                                f"📤 Uploading PDF: {pdf_clean_title}"
-                                            )
-                                        )
-                                        logger.info(f"✅ Successfully uploaded PDF: {pdf_clean_title}")
-                                    except Exception as e:
-                                        logger.error(f"Error uploading PDF: {str(e)}")
-                                        if "FLOOD_WAIT" in str(e):
-                                            await handle_flood_wait(e, status_msg)
-                                            continue
-                                    finally:
-                                        if os.path.exists(pdf_path):
-                                            os.remove(pdf_path)
-                                else:
-                                    logger.error(f"PDF file is empty or doesn't exist: {pdf_path}")
-                                    await message.reply_text(f"❌ PDF download failed (empty file): {pdf_clean_title}")
-                            else:
-                                logger.error(f"Failed to download PDF: {pdf_url}")
-                                await message.reply_text(f"❌ Failed to download PDF: {pdf_clean_title}")
-                    # Delay between entries
-                    if i < len(entries) - 1:  # Don't delay after last entry
-                        await asyncio.sleep(MIN_DELAY_BETWEEN_ENTRIES)
-
-                    except Exception as e:
-                        logger.error(f"Error processing entry {i+1}: {str(e)}")
-                        await message.reply_text(f"❌ Error processing entry {i+1}: {str(e)}")
-                        # Clean up any remaining files
-                        for temp_file in [ts_file]:
-                            if 'temp_file' in locals() and os.path.exists(temp_file):
-                                os.remove(temp_file)
-
-            await safe_edit_message(status_msg, f"✅ Processing complete!\n📹 {total_videos} videos\n📚 {total_pdfs} PDFs")
+                try:
+                    if file_size > MAX_UPLOAD_BYTES:
+                        # Over Telegram's limit: send playable parts as soon as each is cut
+                        await safe_edit_message(status_msg, f"✂️ Splitting {humanbytes(file_size)} into parts...")
+                        kind = 'audio' if output_format == 'mp3' else 'video'
+
+                        async def send_part(part_file, index):
+                            return await message.reply_document(
+                                part_file,
+                                caption=f"{format_emoji} {kind.capitalize()} - Part {index}",
+                                file_name=f"{kind}_{timestamp}_part{index}.{output_format}",
+                                progress=progress,
+                                progress_args=(
+                                    status_msg,
+                                    time.time(),
+                                    f"📤 Uploading part {index}..."
+                                )
+                            )
 
-        else:  # Single URL
-            status_msg = await message.reply_text("⏳ Processing single URL...")
-            timestamp = int(datetime.now().timestamp())
-            ts_file = f"video_{message.from_user.id}_{timestamp}.ts"
-
-            downloaded_file = await process_m3u8(message.text, ts_file, status_msg)
-
-            if downloaded_file and os.path.exists(downloaded_file):
-                await safe_edit_message(status_msg, f"🔄 Converting to {output_format.upper()}...")
-
-                # Fast conversion with streaming optimization
-                result_file = await convert_to_format_fast(downloaded_file, output_format, enable_streaming=True)
-
-                if result_file and os.path.exists(result_file):
-                    start_time = time.time()
-                    file_size = os.path.getsize(result_file)
-
-                    try:
-                        format_emoji = "🎵" if output_format == 'mp3' else "🎥"
-
-                        # Choose upload method based on file size and format
-                        if output_format in ['mp4', 'mkv'] and file_size < 3000 * 1024 * 1024:  # Less than 50MB
-                            # Use video upload for better streaming support
-                            with open(result_file, 'rb') as video_file:
-                                await message.reply_video(
-                                    video=video_file,
-                                    caption=f"{format_emoji} Video - Streaming Optimized",
-                                    file_name=f"video_{timestamp}.{output_format}",
-                                    supports_streaming=True,
-                                    width=1920,  # Set appropriate width
-                                    height=1080,  # Set appropriate height
-                                    duration=0,  # Let Telegram detect duration
-                                    progress=progress,
-                                    progress_args=(
-                                        status_msg,
-                                        start_time,
-                                        f"📤 Uploading {output_format.upper()}..."
-                                    )
+                        await send_in_parts(result_file, send_part)
+                        # Several messages have no single file_id to resend later
+                        sent = None
+                    # Choose upload method based on file size and format
+                    elif output_format in ['mp4', 'mkv'] and file_size < 3000 * 1024 * 1024:  # Less than 50MB
+                        # Use video upload for better streaming support
+                        with open(result_file, 'rb') as video_file:
+                            sent = await message.reply_video(
+                                video=video_file,
+                                caption=f"{format_emoji} Video - Streaming Optimized",
+                                file_name=f"video_{timestamp}.{output_format}",
+                                supports_streaming=True,
+                                width=1920,  # Set appropriate width
+                                height=1080,  # Set appropriate height
+                                duration=0,  # Let Telegram detect duration
+                                progress=progress,
+                                progress_args=(
+                                    status_msg,
+                                    start_time,
+                                    f"📤 Uploading {output_format.upper()}..."
                                 )
-                        else:
-                            # Use document upload for larger files or audio
-                            with open(result_file, 'rb') as doc_file:
-                                await message.reply_document(
-                                    document=doc_file,
-                                    caption=f"{format_emoji} {'Audio' if output_format == 'mp3' else 'Video'}",
-                                    file_name=f"{'audio' if output_format == 'mp3' else 'video'}_{timestamp}.{output_format}",
-                                    progress=progress,
-                                    progress_args=(
-                                        status_msg,
-                                        start_time,
-                                        f"📤 Uploading {output_format.upper()}..."
-                                    )
+                            )
+                    else:
+                        # Use document upload for larger files or audio
+                        with open(result_file, 'rb') as doc_file:
+                            sent = await message.reply_document(
+                                document=doc_file,
+                                caption=f"{format_emoji} {'Audio' if output_format == 'mp3' else 'Video'}",
+                                file_name=f"{'audio' if output_format == 'mp3' else 'video'}_{timestamp}.{output_format}",
+                                progress=progress,
+                                progress_args=(
+                                    status_msg,
+                                    start_time,
+                                    f"📤 Uploading {output_format.upper()}..."
                                 )
-
-                    except Exception as e:
-                        logger.error(f"Upload error: {str(e)}")
-                        if "FLOOD_WAIT" in str(e):
-                            await handle_flood_wait(e, status_msg)
-                            # Retry with document upload after flood wait
+                            )
+                    if reusable(result_file):
+                        file_ids.put(content_key, sent)
+
+                except Exception as e:
+                    logger.error(f"Upload error: {str(e)}")
+                    # FloodWaits were already retried by the limiter
+                    await message.reply_text(f"❌ Upload error: {str(e)}")
+                finally:
+                    # Clean up files
+                    for file_path in [result_file]:
+                        if os.path.exists(file_path):
                             try:
-                                with open(result_file, 'rb') as retry_file:
-                                    await message.reply_document(
-                                        document=retry_file,
-                                        caption=f"{format_emoji} {'Audio' if output_format == 'mp3' else 'Video'} - Retry",
-                                        file_name=f"{'audio' if output_format == 'mp3' else 'video'}_{timestamp}.{output_format}",
-                                        progress=progress,
-                                        progress_args=(
-                                            status_msg,
-                                            time.time(),
-                                            f"📤 Retrying upload {output_format.upper()}..."
-                                        )
-                                    )
-                            except Exception as retry_error:
-                                logger.error(f"Retry upload failed: {str(retry_error)}")
-                                await message.reply_text("❌ Upload failed after retry")
-                        else:
-                            await message.reply_text(f"❌ Upload error: {str(e)}")
-                    finally:
-                        # Clean up files
-                        for file_path in [result_file, downloaded_file]:
-                            if os.path.exists(file_path):
-                                try:
-                                    os.remove(file_path)
-                                except Exception as cleanup_error:
-                                    logger.error(f"Cleanup error: {str(cleanup_error)}")
-                else:
-                    await message.reply_text("❌ Conversion failed")
+                                os.remove(file_path)
+                            except Exception as cleanup_error:
+                                logger.error(f"Cleanup error: {str(cleanup_error)}")
+                    forget_output(result_file)
             else:
-                await message.reply_text("❌ Download failed")
+                await message.reply_text("❌ Download or conversion failed")
 
     except Exception as e:
         logger.error(f"Handler error: {str(e)}")
@@ -823,6 +887,7 @@ async def handle_command(client, message):
             "PDF_URL 1\n\n"
             "[Category] Title 2:URL 2\n\n"
             "📌 **Audio extracted as high-quality MP3**\n"
+            "📌 **Only the audio stream is downloaded when the playlist has one**\n"
             "📌 **Fast processing with optimized encoding**\n"
             "📌 **PDFs downloaded in sequential order**"
         )
@@ -854,6 +919,8 @@ async def handle_command(client, message):
             "[Category] Title 2:URL 2\n\n"
             "Commands:\n"
             "/m3u8 - Download as **MKV** (High Quality)\n"
+            "/m3u8 720 - Pick a resolution, then reply to that command with your URL or file\n"
+            "/m3u8 30m - Record a live stream for at most 30 minutes (also works with 720 30m)\n"
             "/mp4 - Convert to **MP4** (Streaming Optimized)\n"
             "/mp3 - Extract audio as **MP3**\n\n"
             "📌 **Fast processing with optimized encoding**\n"
@@ -7,6 +7,13 @@ from pyrogram import Client, filters
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 from pyrogram.enums import ParseMode
 import yt_dlp
+from helpers.cache import cache, cache_key
+from helpers.fileids import file_ids
+from helpers.ratelimit import limiter
+from helpers.progress import progress_ticker
+from helpers.jobs import cancel_button, check_cancelled, enqueue, track_temp
+from helpers.workspace import release_space, reserve_space, work_path
+from helpers.split import MAX_UPLOAD_BYTES, estimate_size, parts_needed, send_in_parts
 
 # Set up logging
 logging.basicConfig(
@@ -85,7 +92,8 @@ async def help_command(client, message: Message):
             "2. Send the YouTube link\n"
             "3. Choose format (Audio/Video)\n"
             "4. For video, select quality\n\n"
-            "Note: Maximum file size: 4GB",
+            f"Note: Files over {MAX_UPLOAD_BYTES // 1024 ** 2} MB are split into playable parts, "
+            f"each up to {MAX_UPLOAD_BYTES // 1024 ** 2} MB",
             parse_mode=ParseMode.MARKDOWN
         )
     except Exception as e:
@@ -162,7 +170,10 @@ async def handle_callback(client, callback_query):
 
         if data == 'choose_audio':
             await callback_query.edit_message_text("🎵 Downloading audio...")
-            await process_and_send(client, callback_query.message, links, 'audio')
+            await enqueue(
+                callback_query.message, user_id, "YouTube audio",
+                lambda: process_and_send(client, callback_query.message, links, 'audio')
+            )
         elif data == 'choose_video':
             keyboard = InlineKeyboardMarkup([
                 [
@@ -179,7 +190,10 @@ async def handle_callback(client, callback_query):
         elif data.startswith('video_'):
             quality = data.replace('video_', '')
             await callback_query.edit_message_text(f"🎥 Downloading {quality}p video...")
-            await process_and_send(client, callback_query.message, links, data)
+            await enqueue(
+                callback_query.message, user_id, f"YouTube {quality}p video",
+                lambda: process_and_send(client, callback_query.message, links, data)
+            )
         elif data == 'choose_cancel':
             await callback_query.edit_message_text("❌ Download cancelled.")
         
@@ -190,21 +204,34 @@ async def handle_callback(client, callback_query):
         logger.error(f"Error in callback: {e}")
         await callback_query.edit_message_text("❌ An error occurred. Please try again.")
 
+def output_size(info, mode):
+    """Expected size of the finished file, from yt-dlp's sizes or bitrates of the chosen formats"""
+    if mode == 'audio':
+        # Extracted to MP3 at 192 kbps
+        return estimate_size(192000, info.get('duration')) or 0
+    total = 0
+    for f in info.get('requested_formats') or [info]:
+        bitrate = f['tbr'] * 1000 if f.get('tbr') else None
+        total += estimate_size(bitrate, info.get('duration'), f.get('filesize') or f.get('filesize_approx')) or 0
+    return total
+
+def expected_size(info, mode):
+    """Disk space a yt-dlp download needs until its upload is done"""
+    size = output_size(info, mode)
+    # Downloaded streams sit next to the merged or extracted result
+    size *= 2
+    if parts_needed(size // 2) > 1:
+        # Room for the part being uploaded and the one being cut
+        size += 2 * MAX_UPLOAD_BYTES
+    return size
+
 async def download_youtube(link, mode, cookies_file=None, progress_callback=None):
     logger.info(f"Starting download for {link} in mode {mode}")
-    try:
-        # Test tmp directory
-        test_file = "/tmp/test_write.txt"
-        with open(test_file, "w") as f:
-            f.write("test")
-        os.remove(test_file)
-        logger.info("Successfully tested /tmp directory write access")
-    except Exception as e:
-        logger.error(f"Failed to write to /tmp directory: {e}")
-        raise
+    loop = asyncio.get_running_loop()
+    work_dir = work_path()
 
     def get_stream():
-        outtmpl = "/tmp/%(title).60s.%(ext)s"
+        outtmpl = os.path.join(work_dir, "%(title).60s.%(ext)s")
         ydl_opts = {
             "progress_hooks": [progress_callback] if progress_callback else [],
             "format": "best",
@@ -252,13 +279,19 @@ async def download_youtube(link, mode, cookies_file=None, progress_callback=None
         try:
             with yt_dlp.YoutubeDL(ydl_opts) as ydl:
                 logger.info(f"Starting download with yt-dlp: {link}")
-                info = ydl.extract_info(link, download=True)
+                info = ydl.extract_info(link, download=False)
+                # Hold the disk space on the event loop before yt-dlp writes anything
+                # Known before anything is downloaded, unlike the file's real size
+                if parts_needed(output_size(info, mode)) > 1:
+                    logger.info(f"{link} is expected over the upload limit, it will be split")
+                asyncio.run_coroutine_threadsafe(reserve_space(expected_size(info, mode)), loop).result()
+                info = ydl.process_ie_result(info, download=True)
                 if mode == 'audio':
                     filename = ydl.prepare_filename(info).rsplit('.', 1)[0] + '.mp3'
                 else:
                     ext = 'mp4'
                     filename = ydl.prepare_filename(info).rsplit('.', 1)[0] + f'.{ext}'
-                safe_filename = '/tmp/' + sanitize_filename(os.path.basename(filename))
+                safe_filename = os.path.join(work_dir, sanitize_filename(os.path.basename(filename)))
                 if filename != safe_filename and os.path.exists(filename):
                     os.rename(filename, safe_filename)
                 return safe_filename if os.path.exists(safe_filename) else filename
@@ -273,34 +306,42 @@ async def process_and_send(client, message, links, mode):
     cookies_file = 'cookies.txt' if os.path.exists('cookies.txt') else None
     for link in links:
         try:
-            progress_msg = await message.reply(f"🎯 Processing: {link}")
-            last_percent = -1
+            content_key = cache_key(link, mode, 'mp3' if mode == 'audio' else 'mp4')
+            # Delivered before: Telegram can resend it without us touching YouTube
+            if await file_ids.send(message, content_key):
+                logger.info(f"Resent cached file for {link}")
+                continue
 
-            async def edit_progress(d):
-                if d['status'] == 'downloading':
-                    total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
-                    downloaded = d.get('downloaded_bytes', 0)
-                    speed = d.get('speed')
-                    eta = d.get('eta')
-                    if total and downloaded:
-                        percent = int(100 * downloaded / total)
-                        nonlocal last_percent
-                        if percent != last_percent and percent % 5 == 0:  # Update every 5%
-                            last_percent = percent
-                            bar = make_sexy_progress_bar(downloaded, total, speed, eta)
-                            try:
-                                await progress_msg.edit_text(
-                                    bar + f"\n[`{link}`]",
-                                    parse_mode=ParseMode.MARKDOWN,
-                                    disable_web_page_preview=True
-                                )
-                            except Exception as e:
-                                logger.error(f"Error updating progress: {str(e)}")
+            progress_msg = await message.reply(f"🎯 Processing: {link}", reply_markup=cancel_button())
 
-            def progress_hook(d):
-                asyncio.run_coroutine_threadsafe(edit_progress(d), client.loop)
+            def render_progress(d):
+                if d['status'] != 'downloading':
+                    return None
+                total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
+                downloaded = d.get('downloaded_bytes', 0)
+                if not (total and downloaded):
+                    return None
+                bar = make_sexy_progress_bar(downloaded, total, d.get('speed'), d.get('eta'))
+                return bar + f"\n[`{link}`]"
 
-            file_path = await download_youtube(link, mode, cookies_file, progress_hook)
+            # The yt-dlp hook only stores the latest status; one ticker edits the message
+            async with progress_ticker(
+                progress_msg, render_progress,
+                parse_mode=ParseMode.MARKDOWN, disable_web_page_preview=True, reply_markup=cancel_button()
+            ) as progress_slot:
+                def progress_hook(d):
+                    # Raising here is the only way to stop yt-dlp's worker thread
+                    check_cancelled()
+                    track_temp(d.get('tmpfilename'), d.get('filename'))
+                    progress_slot.update(d)
+
+                # Same video in the same mode: reuse the earlier download
+                file_path = await cache.fetch(
+                    content_key,
+                    lambda: download_youtube(link, mode, cookies_file, progress_hook),
+                    dest_dir=work_path()
+                )
+                track_temp(file_path)
             
             if not os.path.exists(file_path):
                 await message.reply("❌ Download failed, file not found!")
@@ -312,13 +353,26 @@ async def process_and_send(client, message, links, mode):
                 os.remove(file_path)
                 continue
 
-            if size > 4 * 1024 * 1024 * 1024:  # 4GB limit
-                await message.reply("❌ File too large! Max 4GB allowed.")
+            if size > MAX_UPLOAD_BYTES:
+                # Too big for one message: send playable parts as soon as each is cut
+                await limiter.edit(
+                    progress_msg, f"✂️ Splitting into ~{parts_needed(size)} parts for Telegram...",
+                    reply_markup=cancel_button()
+                )
+                await send_in_parts(
+                    file_path, lambda part, index: message.reply_document(part, caption=f"Part {index}")
+                )
                 os.remove(file_path)
+                await progress_msg.delete()
+                logger.info(f"Successfully sent {link} in parts")
                 continue
 
-            await progress_msg.edit_text("✅ Uploading to Telegram...", parse_mode=ParseMode.MARKDOWN)
-            await message.reply_document(file_path)
+            await limiter.edit(
+                progress_msg, "✅ Uploading to Telegram...",
+                parse_mode=ParseMode.MARKDOWN, reply_markup=cancel_button()
+            )
+            sent = await message.reply_document(file_path)
+            file_ids.put(content_key, sent)
             os.remove(file_path)
             await progress_msg.delete()
             logger.info(f"Successfully processed and sent file for {link}")
@@ -328,3 +382,6 @@ async def process_and_send(client, message, links, mode):
                 f"❌ Failed for {link}:\n`{str(e)}`",
                 parse_mode=ParseMode.MARKDOWN
             )
+        finally:
+            # Links go one at a time; the next one reserves its own space
+            release_space()